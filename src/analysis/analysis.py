@@ -83,10 +83,13 @@ class PacketSearch:
         pkt = USBmon(bytes(packet))
         id = pkt.id
 
+        # Only control transfers have a setup packet.
+        setup = pkt.setup if pkt.setup is not None else b'\x00'*8
+
         new_pkt = USBPacket(
             0,
             pkt.epnum,
-            pkt.setup,
+            setup,
             bytes(pkt.payload)
         )
 
@@ -7,6 +7,8 @@ import click
 from commands.server import server
 from commands.pcap import pcap
 from commands.emulate import emulate
+from commands.bench import bench
+from commands.proxy import proxy
 
 logging.basicConfig(
     format='[%(asctime)s] %(message)s',
@@ -22,6 +24,8 @@ def main():
 main.add_command(server)
 main.add_command(pcap)
 main.add_command(emulate)
+main.add_command(bench)
+main.add_command(proxy)
 
 
 if __name__ == "__main__":
@@ -0,0 +1,271 @@
+"""
+Benchmarks for the server.
+"""
+import asyncio
+import logging
+import multiprocessing
+import os
+import socket
+import statistics
+import struct
+import tempfile
+import time
+import click
+
+from usbip import ENGINES
+from usbip.client import parse_server, USBIPClient
+from usbip.listen import tcp_address, unix_address
+from usbip.loopback import LoopbackClient
+from usbip.message import pack_op_request, USBIPCommands
+from usbip.usbip import pack_cmd_submit, USBIPDirection
+from devices.testdevice import TestDevice
+from device.devicelist import DeviceList
+
+# GET_DESCRIPTOR for the device descriptor.
+SETUP = bytes.fromhex('8006000100001200')
+
+
+def serve(engine, address):
+    # Keep the per connection logging out of the results.
+    logging.getLogger().setLevel(logging.WARNING)
+    device_list = DeviceList()
+    device_list.register((1, 1), TestDevice())
+    ENGINES[engine](None, None, device_list, listen=[address]).start()
+
+
+def connect(address):
+    if address.kind == 'unix':
+        sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        try:
+            sock.connect(address.path)
+        except OSError:
+            sock.close()
+            raise
+        return sock
+
+    sock = socket.create_connection((address.host, address.port))
+    sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+    return sock
+
+
+def start_server(engine, address):
+    """
+    Run a server in its own process, returning once it is accepting.
+    """
+    process = multiprocessing.Process(
+        target=serve, args=(engine, address), daemon=True
+    )
+    process.start()
+
+    deadline = time.monotonic() + 10
+    while time.monotonic() < deadline:
+        try:
+            connect(address).close()
+            return process
+        except (ConnectionRefusedError, FileNotFoundError):
+            time.sleep(0.05)
+
+    process.terminate()
+    raise click.ClickException(f'{engine} server did not start')
+
+
+def free_port(host):
+    with socket.socket() as sock:
+        sock.bind((host, 0))
+        return sock.getsockname()[1]
+
+
+class BenchClient:
+    """
+    Minimal blocking client, enough to import a device and time URBs.
+    """
+
+    def __init__(self, sock):
+        self.sock = sock
+        self.buffer = bytearray()
+
+    def read(self, n):
+        while len(self.buffer) < n:
+            data = self.sock.recv(0x10000)
+            if not data:
+                raise click.ClickException('server closed the connection')
+            self.buffer += data
+        data = bytes(self.buffer[:n])
+        del self.buffer[:n]
+        return data
+
+    def import_device(self, busid):
+        self.sock.sendall(
+            pack_op_request(USBIPCommands.OP_REQ_IMPORT, busid)
+        )
+        _, _, status = struct.unpack('>HHI', self.read(8))
+        if status != 0:
+            raise click.ClickException(f'unable to import {busid}')
+        self.read(312)
+
+    def submit(self, seqnum):
+        return pack_cmd_submit(
+            seqnum, 0x00010001, USBIPDirection.USBIP_DIR_IN, 0, 64, SETUP,
+            transfer_flags=0x200
+        )
+
+    def reply(self):
+        header = self.read(48)
+        actual_length, = struct.unpack_from('>I', header, 0x18)
+        self.read(actual_length)
+
+
+def measure(address, urbs, depth):
+    """
+    Time URBs one at a time for latency, and pipelined for throughput.
+    """
+    client = BenchClient(connect(address))
+    client.import_device('1-1')
+
+    latencies = []
+    for seqnum in range(1, urbs // 10 + 1):
+        start = time.perf_counter()
+        client.sock.sendall(client.submit(seqnum))
+        client.reply()
+        latencies.append(time.perf_counter() - start)
+
+    start = time.perf_counter()
+    client.sock.sendall(b''.join(client.submit(i) for i in range(depth)))
+    for seqnum in range(depth, urbs + depth):
+        client.reply()
+        if seqnum < urbs:
+            client.sock.sendall(client.submit(seqnum))
+    elapsed = time.perf_counter() - start
+
+    client.sock.close()
+
+    latencies.sort()
+    return {
+        'p50': statistics.median(latencies) * 1e6,
+        'p99': latencies[int(len(latencies) * 0.99)] * 1e6,
+        'rate': urbs / elapsed
+    }
+
+
+@click.group()
+def bench():
+    pass
+
+
+@bench.command()
+@click.option('--host', default='127.0.0.1')
+@click.option('--urbs', default=20000, help='URBs to submit per engine.')
+@click.option('--depth', default=16, help='URBs kept in flight.')
+def engines(host, urbs, depth):
+    """
+    Compare the server engines on control transfer latency and throughput,
+    over TCP loopback and UNIX sockets.
+    """
+    print(
+        f'{"engine":<10} {"transport":<10} {"p50 (us)":>10} {"p99 (us)":>10} '
+        f'{"URB/s":>10}'
+    )
+    with tempfile.TemporaryDirectory() as tmp:
+        for engine in ENGINES:
+            addresses = [
+                tcp_address(host, free_port(host)),
+                unix_address(os.path.join(tmp, f'{engine}.sock'))
+            ]
+            for address in addresses:
+                process = start_server(engine, address)
+                try:
+                    res = measure(address, urbs, depth)
+                finally:
+                    process.terminate()
+                    process.join()
+
+                print(
+                    f'{engine:<10} {address.kind:<10} {res["p50"]:>10.1f} '
+                    f'{res["p99"]:>10.1f} {res["rate"]:>10.0f}'
+                )
+
+
+@bench.command()
+@click.option('--urbs', default=20000, help='URBs to submit.')
+@click.option('--depth', default=16, help='URBs sent in each batch.')
+def loopback(urbs, depth):
+    """
+    Measure the protocol and device alone, with the in-memory loopback in
+    place of a socket.
+    """
+    logging.getLogger().setLevel(logging.WARNING)
+    device_list = DeviceList()
+    device_list.register((1, 1), TestDevice())
+    client = LoopbackClient(device_list)
+    client.import_device('1-1')
+
+    urb = {'setup': SETUP, 'length': 64}
+    start = time.perf_counter()
+    for _ in range(urbs // depth):
+        client.submit_all([urb] * depth)
+        client.replies.clear()
+    elapsed = time.perf_counter() - start
+
+    print(f'{urbs // depth * depth / elapsed:.0f} URB/s')
+
+
+async def generate(address, busid, urbs, depth):
+    """
+    Keep `depth` URBs in flight on one connection until `urbs` have been
+    completed, returning how many failed.
+    """
+    client = await USBIPClient.connect(address)
+    try:
+        if await client.import_device(busid) is None:
+            raise click.ClickException(f'unable to import {busid}')
+
+        urb = {'setup': SETUP, 'length': 64}
+        sent = min(depth, urbs)
+        inflight = set(client.submit_all([urb] * sent))
+        failed = 0
+        while inflight:
+            done, inflight = await asyncio.wait(
+                inflight, return_when=asyncio.FIRST_COMPLETED
+            )
+            failed += sum(future.result().status != 0 for future in done)
+            # Top the pipeline back up in a single write.
+            more = min(len(done), urbs - sent)
+            if more:
+                inflight.update(client.submit_all([urb] * more))
+                sent += more
+                await client.drain()
+        return failed
+    finally:
+        client.close()
+        await client.closed
+
+
+def _parse_server(ctx, param, value):
+    try:
+        return parse_server(value)
+    except ValueError as e:
+        raise click.BadParameter(str(e))
+
+
+@bench.command()
+@click.option('--connect', default='127.0.0.1', callback=_parse_server,
+              metavar='HOST[:PORT]',
+              help='Server to load, or unix:PATH.')
+@click.option('--busid', multiple=True, default=['1-1'],
+              help='Device to import, each gets a connection of its own.')
+@click.option('--urbs', default=20000, help='URBs to submit per connection.')
+@click.option('--depth', default=16, help='URBs kept in flight.')
+def load(connect, busid, urbs, depth):
+    """
+    Generate load against a running server, or a proxy in front of one.
+    """
+    async def run():
+        return await asyncio.gather(
+            *(generate(connect, device, urbs, depth) for device in busid)
+        )
+
+    start = time.perf_counter()
+    failed = asyncio.run(run())
+    elapsed = time.perf_counter() - start
+
+    print(f'{len(busid) * urbs / elapsed:.0f} URB/s, {sum(failed)} failed')
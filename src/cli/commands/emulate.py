@@ -7,7 +7,7 @@ import os
 import logging
 from pytermgui import tim
 
-from usbip import USBIPServer
+from .options import server_options, make_server
 from devices.emulateddevice import EmulatedDevice
 from device.devicelist import DeviceList
 
@@ -74,10 +74,9 @@ def recommendation(packet, choice):
 
 
 @click.command()
-@click.option('--host', default='0.0.0.0')
-@click.option('--port', default=3240)
+@server_options
 @click.argument('pcaps', nargs=-1)
-def emulate(host, port, pcaps):
+def emulate(pcaps, **options):
     device_list = DeviceList()
 
     # support either pcapng's or directories with pcapngs.
@@ -101,5 +100,5 @@ def emulate(host, port, pcaps):
     emulated_device = EmulatedDevice(pcaps_, callbacks)
 
     device_list.register((1, 1), emulated_device)
-    usb_server = USBIPServer(host, port, device_list)
+    usb_server = make_server(device_list, **options)
     usb_server.start()
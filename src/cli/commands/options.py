@@ -0,0 +1,112 @@
+"""
+Options shared by the commands that run a server.
+"""
+import click
+from usbip import ENGINES
+from usbip.listen import parse_address
+from usbip.prefork import PreforkServer
+from usbip.router import RouterServer
+from usbip.scheduler import URBScheduler
+from usbip.session import OVERFLOW_POLICIES
+
+
+def _parse_listen(ctx, param, value):
+    try:
+        return [parse_address(address) for address in value]
+    except ValueError as e:
+        raise click.BadParameter(str(e))
+
+
+def _parse_weights(ctx, param, value):
+    weights = {}
+    for weight in value:
+        busid, _, share = weight.partition('=')
+        if not share.isdigit() or int(share) < 1:
+            raise click.BadParameter(f'{weight} is not BUSID=WEIGHT')
+        weights[busid] = int(share)
+    return weights
+
+
+def server_options(command):
+    """
+    Add the listening and tuning options for the server to a command.
+    """
+    options = [
+        click.option('--host', default='0.0.0.0'),
+        click.option('--port', default=3240),
+        click.option('--listen', multiple=True, callback=_parse_listen,
+                     metavar='ADDRESS',
+                     help='Listen on tcp:PORT[:interface=HOST] or unix:PATH '
+                          'instead of --host/--port, can be repeated.'),
+        click.option('--engine', default='twisted',
+                     type=click.Choice(list(ENGINES)),
+                     help='Event loop to run the server on.'),
+        click.option('--workers', default=1,
+                     help='Fork this many server processes sharing the port.'),
+        click.option('--router/--no-router', default=False,
+                     help='Run each device in its own process, with a front '
+                          'process handing connections to them (asyncio).'),
+        click.option('--nodelay/--no-nodelay', default=True,
+                     help='Set TCP_NODELAY on accepted connections.'),
+        click.option('--cork/--no-cork', default=False,
+                     help='Cork the socket while writing batches of replies.'),
+        click.option('--queue-depth', default=32,
+                     help='Maximum URBs in flight per connection.'),
+        click.option('--backlog-limit', default=256,
+                     help='Stop reading from a host with this many URBs '
+                          'waiting to be started.'),
+        click.option('--urb-timeout', default=None, type=float,
+                     help='Fail URBs the device takes longer than this to '
+                          'answer.'),
+        click.option('--write-high', default=0x10000,
+                     help='Stop reading URBs from a host with this many '
+                          'bytes waiting to be sent to it.'),
+        click.option('--write-low', default=0x4000,
+                     help='Start reading again once the backlog is below '
+                          'this (asyncio only).'),
+        click.option('--write-limit', default=0x1000000,
+                     help='Most bytes a connection can hold before the '
+                          'overflow policy applies, and the largest URB '
+                          'accepted from the host.'),
+        click.option('--overflow', default='disconnect',
+                     type=click.Choice(OVERFLOW_POLICIES),
+                     help='Drop the connection, or the data the device has '
+                          'queued, when over --write-limit.'),
+        click.option('--keepalive', default=60,
+                     help='Send TCP keepalives after this many seconds of '
+                          'silence, 0 to turn them off.'),
+        click.option('--idle-timeout', default=None, type=float,
+                     help='Close connections with nothing outstanding that '
+                          'have been quiet for this long.'),
+        click.option('--fair/--no-fair', default=False,
+                     help='Take turns between connections when starting '
+                          'URBs, rather than starting them as they arrive.'),
+        click.option('--urb-rate', default=None, type=float,
+                     help='Limit each connection to this many URBs a second '
+                          '(implies --fair).'),
+        click.option('--weight', multiple=True, callback=_parse_weights,
+                     metavar='BUSID=WEIGHT',
+                     help='Give the host importing BUSID this many turns to '
+                          'every one of the others (implies --fair).')
+    ]
+    for option in reversed(options):
+        command = option(command)
+    return command
+
+
+def make_server(device_list, host, port, engine, workers, router=False,
+                fair=False, urb_rate=None, weight=None, **options):
+    """
+    Build the server for the chosen engine from the options above.
+    """
+    if fair or urb_rate or weight:
+        options['scheduler'] = URBScheduler(rate=urb_rate, weights=weight)
+    if router:
+        if workers > 1:
+            raise click.UsageError('--router and --workers both fork')
+        return RouterServer(host, port, device_list, **options)
+
+    server = ENGINES[engine](host, port, device_list, **options)
+    if workers > 1:
+        return PreforkServer(server, workers)
+    return server
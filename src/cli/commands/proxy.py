@@ -0,0 +1,39 @@
+"""
+Proxy a USBIP server, optionally capturing the URBs passing through.
+"""
+import click
+from protocol.capture import USBmonWriter
+from usbip.listen import tcp_address
+from usbip.client import parse_server
+from usbip.proxy import USBIPProxy
+from .options import _parse_listen
+
+
+def _parse_upstream(ctx, param, value):
+    try:
+        return parse_server(value)
+    except ValueError as e:
+        raise click.BadParameter(str(e))
+
+
+@click.command()
+@click.option('--host', default='0.0.0.0')
+@click.option('--port', default=3240)
+@click.option('--listen', multiple=True, callback=_parse_listen,
+              metavar='ADDRESS',
+              help='Listen on tcp:PORT[:interface=HOST] or unix:PATH '
+                   'instead of --host/--port, can be repeated.')
+@click.option('--upstream', required=True, callback=_parse_upstream,
+              metavar='HOST[:PORT]',
+              help='Server to forward connections to, or unix:PATH.')
+@click.option('--capture', default=None, type=click.Path(dir_okay=False),
+              help='Record the URBs to this file as a usbmon pcap.')
+@click.option('--snaplen', default=0xffff,
+              help='Most bytes of each transfer to capture.')
+def proxy(host, port, listen, upstream, capture, snaplen):
+    writer = None
+    if capture:
+        writer = USBmonWriter.open(capture, snaplen)
+    USBIPProxy(
+        upstream, listen or [tcp_address(host, port)], writer
+    ).start()
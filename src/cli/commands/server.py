@@ -2,16 +2,15 @@
 Entrypoint.
 """
 import click
-from usbip import USBIPServer
+from .options import server_options, make_server
 from devices.testdevice import TestDevice
 from device.devicelist import DeviceList
 
 
 @click.command()
-@click.option('--host', default='0.0.0.0')
-@click.option('--port', default=3240)
-def server(host, port):
+@server_options
+def server(**options):
     device_list = DeviceList()
     device_list.register((1, 1), TestDevice())
-    usb_server = USBIPServer(host, port, device_list)
+    usb_server = make_server(device_list, **options)
     usb_server.start()
@@ -1,44 +1,167 @@
 """
 Base device to inherit from.
 """
+import inspect
+from collections import deque
+from twisted.internet import defer
+
+from .configuration import Configuration
 from .descriptors import \
         DeviceDescriptor, \
         DescriptorTypes, \
         MaxSize
 
-from protocol.usb.setup import \
-        DeviceGetStatus, \
-        DeviceClearFeature, \
-        DeviceSetFeature, \
-        DeviceSetAddress, \
-        DeviceGetDescriptor, \
-        DeviceSetDescriptor, \
-        DeviceGetConfiguration, \
-        DeviceSetConfiguration, \
-        HIDReport, \
-        SetIdle
-
+from protocol.usb.enum import \
+        StandardRequestID as Request, \
+        HIDRequestID as HIDRequest
 from protocol.usb.enum import USBVersions
 from protocol.usb.enum import USBSpeed
 
 
+def control_request(bmRequestType, bRequest, wValue=None, wIndex=None,
+                    wLength=None, no_reply=False):
+    """
+    Mark a device method as the handler for control requests with this
+    bmRequestType and bRequest, and if given, only this wValue, wIndex or
+    wLength.
+
+    The method is called with the setup packet, and returns the response,
+    which is cut down to wLength. With `no_reply`, nothing is sent back.
+    """
+    bRequest = getattr(bRequest, 'value', bRequest)
+
+    def decorate(method):
+        method.__dict__.setdefault('_control_requests', []).append(
+            ((bmRequestType, bRequest), (wValue, wIndex, wLength, no_reply))
+        )
+        return method
+    return decorate
+
+
+def _limit(result, wLength):
+    """
+    Cut a handler's result down to wLength, once there is one, so handlers
+    can answer later with a Deferred or awaitable.
+    """
+    if isinstance(result, defer.Deferred):
+        return result.addCallback(MaxSize, wLength)
+    if inspect.isawaitable(result):
+        return _limit_awaitable(result, wLength)
+    return MaxSize(result, wLength)
+
+
+async def _limit_awaitable(awaitable, wLength):
+    # Left as a coroutine, so the engine runs it on its own loop.
+    return MaxSize(await awaitable, wLength)
+
+
 class BaseDevice:
     """
     Base class to implement more advanced devices on top of.
 
     It takes a dictionary for each of the settings.
+
+    Control requests are dispatched to the methods marked with
+    `control_request`, and anything without a handler goes to
+    `message_handler()`. Subclasses add class or vendor requests the same
+    way:
+
+        @control_request(0xc0, 0x01)
+        def vendor_status(self, setup):
+            return [FixedDescriptor(bytes(1))]
+
+    Handlers can also return a Deferred or awaitable, which the URB
+    completes with once it fires.
     """
     _configurations = []
     _strings = []
     _active_configuration = 0
     _interfaces = []
+    # (bmRequestType, bRequest) -> [(wValue, wIndex, wLength, no_reply,
+    # method name)], built from the @control_request methods.
+    _handlers = {}
+    # Keep descriptors packed after the first time the host asks for them.
+    # Devices whose descriptors change on their own should turn this off, or
+    # call invalidate_descriptors() when they do.
+    cache_descriptors = True
+    # Most descriptors kept, as the host picks wValue / wIndex of the key.
+    descriptor_cache_size = 64
+
+    def __init_subclass__(cls, **kwargs):
+        super().__init_subclass__(**kwargs)
+        cls._compile_handlers()
+
+    @classmethod
+    def _compile_handlers(cls):
+        """
+        Build the handler table for this class from the methods marked with
+        `control_request`, including inherited ones.
+
+        Handlers are called by name, so overriding a method keeps its
+        requests without marking it again. Handlers from subclasses, and
+        those matching on more fields, are tried first.
+        """
+        handlers = {}
+        for klass in reversed(cls.__mro__):
+            for name, attr in vars(klass).items():
+                for key, match in getattr(attr, '_control_requests', ()):
+                    handlers.setdefault(key, []).insert(0, (*match, name))
+
+        for entries in handlers.values():
+            entries.sort(key=lambda entry: entry[:3].count(None))
+        cls._handlers = handlers
 
     def __init__(self, settings):
+        # Packed descriptors, by (bmRequestType, bRequest, wValue, wIndex)
+        # of the GET_DESCRIPTOR asking for them.
+        self._descriptors = {}
         self.settings = settings
+        # Data waiting to be sent to the host, by IN endpoint number.
+        self._in_data = {}
+        self._in_bytes = 0
+        self._listeners = []
+        # Cleared while the host isn't keeping up with what we send it.
+        self.producing = True
 
         if 'bConfigurationValue' in self.settings:
             self._active_configuration = self.settings['bConfigurationValue']
 
+    @property
+    def settings(self):
+        return self._settings
+
+    @settings.setter
+    def settings(self, settings):
+        # Changing settings in place needs invalidate_descriptors() too.
+        self._settings = settings
+        self.invalidate_descriptors()
+
+    def invalidate_descriptors(self):
+        """
+        Forget the packed descriptors, so they are built again on the next
+        request.
+        """
+        self._descriptors.clear()
+
+    def cached_descriptor(self, setup, build):
+        """
+        Serve a GET_DESCRIPTOR from the cache, packing what `build(setup)`
+        returns the first time.
+
+        Only descriptors the device has are cached, and once there are
+        `descriptor_cache_size` of them the oldest is dropped for the next.
+        """
+        key = (*setup.request(), setup.wValue(), setup.wIndex())
+        descriptor = self._descriptors.get(key)
+        if descriptor is None:
+            built = build(setup)
+            descriptor = bytes(MaxSize(built, None).pack())
+            if self.cache_descriptors and built is not None:
+                if len(self._descriptors) >= self.descriptor_cache_size:
+                    del self._descriptors[next(iter(self._descriptors))]
+                self._descriptors[key] = descriptor
+        return descriptor[:setup.wLength()]
+
     def speed(self):
         return USBSpeed.HIGH_SPEED.value
 
@@ -78,7 +201,7 @@ class BaseDevice:
         return self.settings.get('bMaxPacketSize', 64)
 
     def bNumInterfaces(self):
-        return len(self._interfaces)
+        return len(self.interfaces())
 
     def iManufacturer(self):
         return self.settings.get('iManufacturer', 0)
@@ -90,7 +213,42 @@ class BaseDevice:
         return self.settings.get('iSerialNumber', 0)
 
     def interfaces(self):
-        return self._interfaces
+        """
+        The interfaces of the active configuration, in their default
+        alternate setting.
+        """
+        frozen = self.active_configuration()
+        if frozen is None:
+            return self._interfaces
+        return [
+            interface
+            for (_, alternate), interface in frozen.interfaces.items()
+            if alternate == 0
+        ]
+
+    def active_configuration(self):
+        """
+        The active configuration as frozen by `Configuration.freeze()`, or
+        None if the device doesn't describe it with a `Configuration`.
+        """
+        configurations = self._configurations
+        if isinstance(configurations, dict):
+            configurations = configurations.values()
+        for configuration in configurations:
+            if isinstance(configuration, Configuration) and \
+                    configuration.bConfigurationValue() == \
+                    self._active_configuration:
+                return configuration.freeze()
+        return None
+
+    def has_endpoint(self, address):
+        """
+        Whether the active configuration has an endpoint with this
+        bEndpointAddress. Devices without a `Configuration` to check accept
+        every endpoint.
+        """
+        frozen = self.active_configuration()
+        return frozen is None or address in frozen.endpoints
 
     def max_power_consumption(self):
         return self.settings.get('bMaxPower', 100)
@@ -98,48 +256,109 @@ class BaseDevice:
     def command(self, packet):
         """
         Process an URB for this device.
+
+        Subclasses can return a Deferred or awaitable instead, for URBs that
+        can't be answered straight away.
         """
         packet_ = self.pre_response(packet)
         setup = packet_.setup
 
-        result = None
-        handled = True
-        no_reply = False
-
-        match setup:
-            # Default Device Requests
-            case _ if isinstance(setup, DeviceGetStatus):
-                result = self.get_status(setup)
-            case _ if isinstance(setup, DeviceClearFeature):
-                result = self.clear_feature(setup)
-            case _ if isinstance(setup, DeviceSetFeature):
-                result = self.set_feature(setup)
-            case _ if isinstance(setup, DeviceSetAddress):
-                result = self.set_address(setup)
-            case _ if isinstance(setup, DeviceGetDescriptor):
-                result = self.get_discriptor(setup)
-            case _ if isinstance(setup, DeviceSetDescriptor):
-                result = self.set_descriptor(setup)
-            case _ if isinstance(setup, DeviceGetConfiguration):
-                result = self.get_configuration(setup)
-            case _ if isinstance(setup, DeviceSetConfiguration):
-                result = self.set_configuration(setup)
-            case _ if isinstance(setup, HIDReport):
-                result = self.hid_report(setup)
-            case _ if isinstance(setup, SetIdle):
-                self.set_idle(setup)
-                no_reply = True
-            case _:
-                handled = False
-
-        if no_reply:
-            return None
+        for wValue, wIndex, wLength, no_reply, name in \
+                self._handlers.get(setup.request(), ()):
+            if (wValue is not None and wValue != setup.wValue()) or \
+                    (wIndex is not None and wIndex != setup.wIndex()) or \
+                    (wLength is not None and wLength != setup.wLength()):
+                continue
 
-        if handled:
-            return MaxSize(result, setup.wLength())
+            result = getattr(self, name)(setup)
+            if no_reply:
+                return None
+            return _limit(result, setup.wLength())
 
         return self.message_handler(packet_)
 
+    # Non-control endpoints.
+    #
+    # IN transfers on these are parked by the server until the device has
+    # something to send, which it provides through push().
+
+    def push(self, endpoint, data):
+        """
+        Queue data to be sent to the host on an IN endpoint.
+
+        Completes a parked URB straight away if there is one, otherwise the
+        data waits for the next one. Must be called from the thread running
+        the server.
+        """
+        endpoint &= 0x0f
+        self._in_data.setdefault(endpoint, deque()).append(data)
+        self._in_bytes += len(data)
+        for listener in self._listeners:
+            listener(endpoint)
+
+    def pull(self, endpoint):
+        """
+        Take the next piece of data queued for an IN endpoint, or None.
+        """
+        queue = self._in_data.get(endpoint)
+        if not queue:
+            return None
+        data = queue.popleft()
+        self._in_bytes -= len(data)
+        return data
+
+    def queued(self):
+        """
+        Number of bytes pushed that the host hasn't taken yet.
+        """
+        return self._in_bytes
+
+    def drop_queued(self):
+        """
+        Throw away everything queued for the host, returning how many bytes
+        that was.
+        """
+        dropped = self._in_bytes
+        self._in_data.clear()
+        self._in_bytes = 0
+        return dropped
+
+    def detached(self):
+        """
+        Called when the host that imported this device disconnects, to drop
+        anything kept for it. Subclasses holding more per-host state should
+        clear that here too.
+        """
+        self.drop_queued()
+        self.producing = True
+
+    def pause_producing(self):
+        """
+        Called when the host isn't keeping up. Devices generating data on
+        their own should hold off pushing any more until
+        `resume_producing()`, see `producing`.
+        """
+        self.producing = False
+
+    def resume_producing(self):
+        self.producing = True
+
+    def receive(self, endpoint, data):
+        """
+        Called with the data from an OUT transfer on a non-control endpoint.
+        """
+        pass
+
+    def subscribe(self, listener):
+        """
+        Call `listener(endpoint)` whenever data is pushed.
+        """
+        self._listeners.append(listener)
+
+    def unsubscribe(self, listener):
+        if listener in self._listeners:
+            self._listeners.remove(listener)
+
     def descriptor(self):
         return DeviceDescriptor(
             {
@@ -166,36 +385,39 @@ class BaseDevice:
 
     # Implementations of standard device requests.
 
-    # GET_STATUS
+    @control_request(0b10000000, Request.GET_STATUS, 0, 0, 2)
     def get_status(self, setup):
         """
         Not implemented yet
         """
         return None
 
-    # CLEAR_FEATURE
+    @control_request(0b00000000, Request.CLEAR_FEATURE, wIndex=0, wLength=0)
     def clear_feature(self, setup):
         """
         Not implemented yet
         """
         return None
 
-    # SET_FEATURE
+    @control_request(0b00000000, Request.SET_FEATURE, wIndex=0, wLength=0)
     def set_feature(self, setup):
         """
         Not implemented yet
         """
         return None
 
-    # SET_ADDRESS
+    @control_request(0b00000000, Request.SET_ADDRESS, wIndex=0, wLength=0)
     def set_address(self, setup):
         """
         Not implemented yet
         """
         return None
 
-    # GET_DESCRIPTOR
+    @control_request(0b10000000, Request.GET_DESCRIPTOR)
     def get_discriptor(self, setup):
+        return self.cached_descriptor(setup, self.build_descriptor)
+
+    def build_descriptor(self, setup):
         match setup.descriptor_type():
             case DescriptorTypes.DEVICE:
                 return self.descriptor()
@@ -215,30 +437,38 @@ class BaseDevice:
                 # Not yet implemented
                 return None
 
-    # SET_DESCRIPTOR
+    @control_request(0b00000000, Request.SET_DESCRIPTOR)
     def set_descriptor(self, setup):
         """
         Not implemented yet
         """
         return None
 
-    # GET_CONFIGURATION
+    @control_request(0b10000000, Request.GET_CONFIGURATION, 0, 0, 1)
     def get_configuration(self, setup):
         """
         Not implemented yet
         """
         return None
 
-    # SET_CONFIGURATION
+    @control_request(0b00000000, Request.SET_CONFIGURATION, wIndex=0,
+                     wLength=0)
     def set_configuration(self, setup):
-        self._active_configuration = setup.configuration_value()
+        if setup.configuration_value() != self._active_configuration:
+            self._active_configuration = setup.configuration_value()
+            self.invalidate_descriptors()
         return None
 
+    # GET_DESCRIPTOR sent to an interface, for HID descriptors.
+    @control_request(0b10000001, Request.GET_DESCRIPTOR)
+    def get_interface_descriptor(self, setup):
+        return self.cached_descriptor(setup, self.hid_report)
+
     # HID REPORT request
     def hid_report(self, setup):
         return None
 
-    # SET_IDLE
+    @control_request(0b00100001, HIDRequest.SET_IDLE, no_reply=True)
     def set_idle(self, setup):
         pass
 
@@ -268,3 +498,6 @@ class BaseDevice:
         that handles the specific device it is implementing.
         """
         return MaxSize(None, 0)
+
+
+BaseDevice._compile_handlers()
@@ -1,8 +1,20 @@
 """
 Configuration of a USB Device.
 """
-from bitarray import bitarray
-from .descriptors import ConfigurationDescriptor
+from collections import namedtuple
+
+from .descriptors import ConfigurationDescriptor, MaxSize
+
+# A configuration packed by `Configuration.freeze()`.
+#
+# `descriptor` is what GET_DESCRIPTOR returns for it, `interfaces` maps
+# (bInterfaceNumber, bAlternateSetting) to each Interface, and `endpoints`
+# maps bEndpointAddress to the (Interface, Endpoint) it belongs to.
+FrozenConfiguration = namedtuple(
+    'FrozenConfiguration', ['descriptor', 'interfaces', 'endpoints']
+)
+
+CONFIGURATION_DESCRIPTOR_LENGTH = 9
 
 
 class Configuration:
@@ -15,53 +27,110 @@ class Configuration:
         self._max_power = int(max_power / 2)
         self._remote_wakeup = remote_wakeup
         self._self_powered = self_powered
+        self._frozen = None
+        # Revisions of the interfaces when _frozen was built.
+        self._revisions = None
 
     def add_interface(self, interface):
         """
         Add an interface to this configuration.
         """
         self.interfaces.append(interface)
+        self._frozen = None
+
+    def bConfigurationValue(self):
+        return self._index
 
     def attributes(self):
         """
-        Attributes as a bitmap
+        bmAttributes, bit 7 is reserved and always set.
         """
-        resp = bitarray()
+        return 0x80 | self._self_powered << 6 | self._remote_wakeup << 5
 
-        resp += [1]
-        resp += [self._self_powered]
-        resp += [self._remote_wakeup]
-        resp += [0, 0, 0, 0, 0]
+    def freeze(self):
+        """
+        Pack the configuration, with its interfaces, their class descriptors
+        and endpoints, into the bytes sent to the host, checking the result
+        is one the host can parse.
 
-        return resp
+        The result is kept until an interface is added, or one of them is
+        changed through its methods.
 
-    def descriptor(self):
+        Raises ValueError if a descriptor's bLength doesn't match what it
+        packs to, two interfaces share an endpoint, or the whole
+        configuration is too long for wTotalLength.
         """
-        Get a descriptor for this configuration
-        """
-        # Size of a configuration descriptor
-        total_length = 9
-        # Interfaces are of a fixed size
-        total_length += len(self.interfaces) * 9
-        # Sum up the number of endpoints.
+        revisions = tuple(interface.revision for interface in self.interfaces)
+        if self._frozen is not None and revisions == self._revisions:
+            return self._frozen
+
+        body = []
+        interfaces = {}
+        endpoints = {}
         for interface in self.interfaces:
-            total_length += 7 * len(interface.endpoints())
+            key = (interface.bInterfaceNumber(), interface.bAlternateSetting())
+            if key in interfaces:
+                raise ValueError(f'Interface {key} is defined twice')
+            interfaces[key] = interface
+
+            body.append(self._pack(interface.descriptor()))
+            for descriptor in interface.class_descriptors():
+                body.append(self._pack(descriptor))
+
+            for endpoint in interface.endpoints():
+                address = endpoint.bEndpointAddress()
+                owner, _ = endpoints.setdefault(address, (interface, endpoint))
+                # Alternate settings of an interface can reuse endpoints.
+                if owner.bInterfaceNumber() != interface.bInterfaceNumber():
+                    raise ValueError(
+                        f'Endpoint {address:#x} is used by interfaces '
+                        f'{owner.bInterfaceNumber()} and '
+                        f'{interface.bInterfaceNumber()}'
+                    )
+                body.append(self._pack(endpoint.descriptor()))
 
-        reply = []
-        reply.append(ConfigurationDescriptor(
+        total_length = CONFIGURATION_DESCRIPTOR_LENGTH + sum(map(len, body))
+        if total_length > 0xffff:
+            raise ValueError(f'Configuration is {total_length} bytes long')
+
+        header = ConfigurationDescriptor(
             {
                 'wTotalLength': total_length,
-                'bNumInterfaces': len(self.interfaces),
+                'bNumInterfaces': len({number for number, _ in interfaces}),
                 'bConfigurationValue': self._index,
                 'iConfiguration': self._name_idx,
-                'bmAttributes': int.from_bytes(self.attributes(), 'little'),
+                'bmAttributes': self.attributes(),
                 'bMaxPower': self._max_power
             }
-        ))
-        for interface in self.interfaces:
-            reply.append(interface.descriptor())
-            # now get the endpoints.
-            for endpoint in interface.endpoints():
-                reply.append(endpoint.descriptor())
+        ).pack()
 
-        return reply
+        self._frozen = FrozenConfiguration(
+            b''.join([header, *body]), interfaces, endpoints
+        )
+        self._revisions = revisions
+        return self._frozen
+
+    @staticmethod
+    def _pack(descriptor):
+        """
+        Pack a descriptor, checking the bLengths in it add up to its size,
+        so a wrong one can't throw the host's parsing out of step.
+        """
+        packed = bytes(MaxSize(descriptor, None).pack())
+        offset = 0
+        while offset < len(packed):
+            if packed[offset] < 2:
+                break
+            offset += packed[offset]
+        if not packed or offset != len(packed):
+            raise ValueError(
+                f'{type(descriptor).__name__} packs to {len(packed)} bytes, '
+                f'which its bLength does not match'
+            )
+        return packed
+
+    def descriptor(self):
+        """
+        Get a descriptor for this configuration
+        """
+        return self.freeze().descriptor
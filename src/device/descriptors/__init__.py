@@ -1,6 +1,7 @@
 from .configuration import *
 from .device import *
 from .endpoint import *
+from .hid import *
 from .interface import *
 from .maxsize import *
 from .string import *
@@ -2,36 +2,53 @@
 Classes implementing various USB descriptors.
 """
 import struct
-import copy
+from operator import attrgetter
 
+# struct formats for the field sizes used in ORDER.
+_FORMATS = {1: 'B', 2: 'H', 4: 'I'}
 
-class BaseDescriptor:
-    def __init__(self, data):
-        data_fixed = copy.deepcopy(data)
 
-        # Compute the max size, in case this needs bLength
-        bLength = sum(i for i, _ in self.ORDER)
-        if 'bLength' not in data_fixed:
-            data_fixed['bLength'] = bLength
+class DescriptorMeta(type):
+    """
+    Compiles the ORDER of a descriptor class into a single struct.Struct when
+    the class is created, with a slot for each field.
 
-        if 'bDescriptorType' not in data_fixed:
-            data_fixed['bDescriptorType'] = self.TYPE.value
+    Classes without an ORDER, which pack themselves, are left alone.
+    """
 
-        self.data = data_fixed
+    def __new__(mcs, name, bases, namespace):
+        order = namespace.get('ORDER')
+        if order is not None:
+            fields = tuple(key for _, key in order)
+            namespace.setdefault('__slots__', fields)
+            namespace['_FIELDS'] = fields
+            namespace['_STRUCT'] = struct.Struct(
+                '<' + ''.join(_FORMATS[size] for size, _ in order)
+            )
+            namespace['_values'] = attrgetter(*fields)
+        return super().__new__(mcs, name, bases, namespace)
 
-    def pack(self, max_length=None):
-        if max_length and self.data['bLength'] > max_length:
-            self.data['bLength'] = max_length
 
-        message = b''
-        for size, key in self.ORDER:
-            match size:
-                case 1:
-                    message += struct.pack('<B', self.data[key])
-                case 2:
-                    message += struct.pack('<H', self.data[key])
+class BaseDescriptor(metaclass=DescriptorMeta):
+    __slots__ = ()
 
-        if max_length:
-            message = message[:max_length]
+    def __init__(self, data):
+        # ORDER always starts with bLength and bDescriptorType, which default
+        # to the full size and the class's type.
+        self.bLength = data.get('bLength', self._STRUCT.size)
+        self.bDescriptorType = data.get('bDescriptorType', self.TYPE.value)
+        for key in self._FIELDS[2:]:
+            setattr(self, key, data[key])
+
+    @property
+    def data(self):
+        """
+        The fields as a dictionary, as descriptors used to store them.
+        """
+        return dict(zip(self._FIELDS, self._values(self)))
 
+    def pack(self, max_length=None):
+        message = self._STRUCT.pack(*self._values(self))
+        if max_length:
+            return message[:max_length]
         return message
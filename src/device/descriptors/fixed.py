@@ -7,9 +7,12 @@ class FixedDescriptor(BaseDescriptor):
 
     Used to send descriptors that were previously logged.
     """
+    __slots__ = ('descriptor', )
 
     def __init__(self, descriptor):
         self.descriptor = descriptor
 
-    def pack(self):
+    def pack(self, max_length=None):
+        if max_length:
+            return self.descriptor[:max_length]
         return self.descriptor
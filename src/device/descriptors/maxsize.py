@@ -5,6 +5,7 @@ class MaxSize(BaseDescriptor):
     """
     Wrapper around a descriptor, so that pack() doesn't require an argument.
     """
+    __slots__ = ('descriptor', 'max_size')
 
     def __init__(self, descriptor, max_size):
         self.descriptor = descriptor
@@ -15,6 +16,9 @@ class MaxSize(BaseDescriptor):
         if not self.descriptor:
             return res
 
+        if isinstance(self.descriptor, (bytes, bytearray, memoryview)):
+            return self.descriptor[:self.max_size]
+
         if isinstance(self.descriptor, BaseDescriptor):
             return self.descriptor.pack(self.max_size)
 
@@ -9,6 +9,7 @@ class String0Descriptor(BaseDescriptor):
     String descriptor at index 0 returns a list of all the supported languages.
     """
     TYPE = DescriptorTypes.STRING
+    __slots__ = ('languages', )
 
     def __init__(self, languages):
         self.languages = languages
@@ -31,6 +32,7 @@ class String0Descriptor(BaseDescriptor):
 
 class StringDescriptor(BaseDescriptor):
     TYPE = DescriptorTypes.STRING
+    __slots__ = ('string', )
 
     def __init__(self, string):
         if isinstance(string, tuple):
@@ -39,10 +41,8 @@ class StringDescriptor(BaseDescriptor):
             self.string = string
 
     def pack(self, max_length=None):
-        string = self.string.encode('utf-16')[2:]
+        string = self.string.encode('utf-16-le')
         length = len(string) + 2
-        if max_length and max_length < length:
-            length = self.max_length
 
         message = b''
         message += struct.pack('<B', length)
@@ -1,25 +1,212 @@
 """
 Implementation of a device list.
 """
+import fcntl
+import os
+from collections import deque
+
+from usbip.message import pack_device_record, pack_interface_records
 
 
 class DeviceList:
     """
     Device List, allowing registering devices and then packing them in a form
     that can be sent over the network.
+
+    Devices are keyed by their busid, either as a (busnum, devnum) tuple or
+    the 'busnum-devnum' string the host uses, and both can be used for
+    lookups. `add()` picks a free busid for a device.
+
+    Each device's OP_REP_DEVLIST / OP_REP_IMPORT records are packed when it is
+    registered, so replying to a list or import doesn't need to touch the
+    devices at all. Call `refresh()` if a device changes after registering.
+
+    A device can only be imported by one connection at a time, which holds it
+    with `claim()` until `release()` / `release_all()`. Processes with their
+    own copy of the list, such as pre-fork workers, only see each other's
+    claims after `share_claims()`.
     """
 
+    # USB addresses run from 1 to 127 on each bus.
+    MAX_DEVNUM = 127
+
     def __init__(self):
         self._devices = {}
+        # 'busnum-devnum' -> (busnum, devnum)
+        self._names = {}
+        # busid -> (device record, interface records)
+        self._records = {}
+        # Joined records of every device, built on the next devlist.
+        self._devlist = None
+        # busid -> owner, and owner -> busids it holds.
+        self._owners = {}
+        self._claims = {}
+        # Lock files backing the claims, see share_claims().
+        self._lock_dir = None
+        self._locks = {}
+        # Allocation state for add().
+        self._next = (1, 1)
+        self._free = deque()
+
+    def _busid(self, busid):
+        if isinstance(busid, str):
+            return self._names.get(busid)
+        return busid
 
     def register(self, busid, device):
         self._devices[busid] = device
+        self._names['{}-{}'.format(*busid)] = busid
+        self.refresh(busid)
 
     def unregister(self, busid):
+        busid = self._busid(busid)
         del self._devices[busid]
+        del self._records[busid]
+        del self._names['{}-{}'.format(*busid)]
+        self._devlist = None
+
+        owner = self._owners.pop(busid, None)
+        if owner is not None:
+            self._claims[owner].discard(busid)
+            self._unlock(busid)
+
+        self._free.append(busid)
+
+    def allocate(self):
+        """
+        Return a busid not used by any device.
+        """
+        while self._free:
+            busid = self._free.popleft()
+            if busid not in self._devices:
+                return busid
+
+        while self._next in self._devices:
+            self._advance()
+        busid = self._next
+        self._advance()
+        return busid
+
+    def _advance(self):
+        busnum, devnum = self._next
+        if devnum >= self.MAX_DEVNUM:
+            self._next = (busnum + 1, 1)
+        else:
+            self._next = (busnum, devnum + 1)
+
+    def add(self, device):
+        """
+        Register a device on the next free busid, returning it.
+        """
+        busid = self.allocate()
+        self.register(busid, device)
+        return busid
+
+    def refresh(self, busid):
+        """
+        Repack the records for a device.
+        """
+        busid = self._busid(busid)
+        busnum, devnum = busid
+        device = self._devices[busid]
+        self._records[busid] = (
+            pack_device_record(busnum, devnum, device),
+            pack_interface_records(device)
+        )
+        self._devlist = None
 
     def lookup(self, busid):
-        return self._devices.get(busid)
+        return self._devices.get(self._busid(busid))
 
     def devices(self):
         return self._devices.keys()
+
+    def record(self, busid):
+        """
+        The device record for a busid, as sent in OP_REP_IMPORT.
+        """
+        records = self._records.get(self._busid(busid))
+        if records is None:
+            return None
+        return records[0]
+
+    def devlist_records(self):
+        """
+        The number of devices, and all their records for OP_REP_DEVLIST.
+        """
+        if self._devlist is None:
+            self._devlist = b''.join(
+                device + interfaces
+                for device, interfaces in self._records.values()
+            )
+        return len(self._records), self._devlist
+
+    def claim(self, busid, owner):
+        """
+        Mark a device as imported by `owner`, returning False if something
+        else already has it.
+        """
+        busid = self._busid(busid)
+        if busid not in self._devices:
+            return False
+
+        current = self._owners.get(busid)
+        if current is not None and current is not owner:
+            return False
+        if current is None and not self._lock(busid):
+            return False
+
+        self._owners[busid] = owner
+        self._claims.setdefault(owner, set()).add(busid)
+        return True
+
+    def owner(self, busid):
+        return self._owners.get(self._busid(busid))
+
+    def release(self, busid, owner):
+        busid = self._busid(busid)
+        if self._owners.get(busid) is not owner:
+            return
+
+        del self._owners[busid]
+        self._claims[owner].discard(busid)
+        self._unlock(busid)
+
+    def release_all(self, owner):
+        """
+        Release every device held by `owner`, when it disconnects.
+        """
+        for busid in self._claims.pop(owner, ()):
+            if self._owners.get(busid) is owner:
+                del self._owners[busid]
+                self._unlock(busid)
+
+    def share_claims(self, directory):
+        """
+        Back claims with a lock file per busid in `directory`, so a device
+        can only be imported once across every process using it.
+
+        The locks belong to the process holding them, so they go with it if
+        it dies.
+        """
+        self._lock_dir = directory
+
+    def _lock(self, busid):
+        if self._lock_dir is None:
+            return True
+
+        path = os.path.join(self._lock_dir, '{}-{}.lock'.format(*busid))
+        fd = os.open(path, os.O_RDWR | os.O_CREAT, 0o600)
+        try:
+            fcntl.flock(fd, fcntl.LOCK_EX | fcntl.LOCK_NB)
+        except BlockingIOError:
+            os.close(fd)
+            return False
+        self._locks[busid] = fd
+        return True
+
+    def _unlock(self, busid):
+        fd = self._locks.pop(busid, None)
+        if fd is not None:
+            # Closing the file drops the lock.
+            os.close(fd)
@@ -1,8 +1,6 @@
 """
 Endpoint
 """
-from bitarray import bitarray
-
 from .descriptors import EndpointDescriptor
 from protocol.usb.enum import TransferType, SynchronisationType, UsageType
 
@@ -20,16 +18,20 @@ class Endpoint:
         self._synchronisation_type = synchronisation_type
         self._usage_type = usage_type
 
-    def attributes(self):
-        resp = bitarray()
+    def bEndpointAddress(self):
+        return self._address
 
-        # this might need fixing when actually implementing ISO transfers.
-        resp += [0, 0]
-        resp += self._usage_type.value
-        resp += self._synchronisation_type.value
-        resp += self._transfer_type.value
+    def attributes(self):
+        """
+        bmAttributes, from the bits in each of the enums.
+        """
+        def field(enum):
+            high, low = enum.value
+            return high << 1 | low
 
-        return resp
+        return field(self._usage_type) << 4 | \
+            field(self._synchronisation_type) << 2 | \
+            field(self._transfer_type)
 
     def descriptor(self):
         """
@@ -39,7 +41,7 @@ class Endpoint:
         return EndpointDescriptor(
             {
                 'bEndpointAddress': self._address,
-                'bmAttributes': int.from_bytes(self.attributes(), 'little'),
+                'bmAttributes': self.attributes(),
                 'wMaxPacketSize': self._max_packet_size,
                 'bInterval': self._interval
             }
@@ -18,22 +18,44 @@ class Interface:
         self._alternate_setting = alternate_setting
         self._name_idx = name_idx
         self._endpoints = []
+        self._class_descriptors = []
+        # Bumped on every change, so configurations holding this interface
+        # know to freeze it again.
+        self.revision = 0
 
     def add_endpoints(self, endpoints):
         self._endpoints = endpoints
+        self.revision += 1
+
+    def add_class_descriptor(self, descriptor):
+        """
+        Add a class specific descriptor, such as a HID descriptor, sent
+        between the interface descriptor and its endpoints.
+        """
+        self._class_descriptors.append(descriptor)
+        self.revision += 1
+
+    def bInterfaceNumber(self):
+        return self._interface_number
+
+    def bAlternateSetting(self):
+        return self._alternate_setting
 
     def bInterfaceClass(self):
-        return self.if_class
+        return self._if_class
 
     def bInterfaceSubClass(self):
-        return self.if_subclass
+        return self._if_subclass
 
     def bInterfaceProtocol(self):
-        return self.if_protocol
+        return self._if_protocol
 
     def endpoints(self):
         return self._endpoints
 
+    def class_descriptors(self):
+        return self._class_descriptors
+
     def descriptor(self):
         """
         Return a descriptor for this interface.
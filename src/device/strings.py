@@ -16,6 +16,10 @@ class Languages(Enum):
 class Strings:
     """
     Manage the strings in a device.
+
+    Every string is encoded into its descriptor up front, along with the
+    String0 list of languages, so requests for them are served from bytes
+    that are ready to send.
     """
 
     def __init__(self, setting):
@@ -23,29 +27,42 @@ class Strings:
             self.languages = {language: {} for language in setting}
         else:
             self.languages = setting
+        # (index, language) -> packed descriptor.
+        self._descriptors = {}
+        self._unknown = StringDescriptor('Unknown').pack()
+        self._encode()
+
+    def _encode(self):
+        self._descriptors = {
+            (index, language): StringDescriptor(string).pack()
+            for language, strings in self.languages.items()
+            for index, string in strings.items()
+        }
+        self._descriptors[(0, 0)] = \
+            String0Descriptor(list(self.languages)).pack()
 
     def set_strings(self, language, strings):
         """
         Update the strings stored for a language.
         """
         active = {}
-        if isinstance(active, list):
+        if isinstance(strings, list):
             for idx, string in enumerate(strings):
                 active[idx + 1] = string
         else:
             active = strings
 
         self.languages[language] = active
+        self._encode()
 
-    def descriptor(self, index, language):
+    def descriptor(self, index, language, max_length=None):
         """
-        Return a descriptor for the given string
+        Return the descriptor for the given string, cut to `max_length`.
         """
-        if index == 0 and language == 0:
-            # just return the String0Descriptor
-            return String0Descriptor(self.languages.keys())
-
-        if index not in self.languages[language]:
-            return StringDescriptor('Unknown')
+        descriptor = self._descriptors.get((index, language))
+        if descriptor is None:
+            if language not in self.languages:
+                raise KeyError(language)
+            descriptor = self._unknown
 
-        return StringDescriptor(self.languages[language][index])
+        return memoryview(descriptor)[:max_length]
@@ -0,0 +1,108 @@
+"""
+Writing usbmon captures, in the format `PCAPAnalysis` reads.
+
+Packets use the 64 byte header from Linux's binary usbmon API, in a pcap
+file with the LINKTYPE_USB_LINUX_MMAPPED link type, same as a capture taken
+with `tcpdump -i usbmon0`.
+
+https://docs.kernel.org/usb/usbmon.html
+"""
+import struct
+import time
+from enum import Enum
+
+LINKTYPE_USB_LINUX_MMAPPED = 220
+USBMON_HEADER_LENGTH = 64
+
+# magic, version major, version minor, thiszone, sigfigs, snaplen, linktype
+_PCAP_HEADER = struct.Struct('<IHHiIII')
+# ts_sec, ts_usec, incl_len, orig_len
+_PCAP_RECORD = struct.Struct('<IIII')
+# id, type, xfer_type, epnum, devnum, busnum, flag_setup, flag_data, ts_sec,
+# ts_usec, status, length, len_cap, setup, interval, start_frame,
+# xfer_flags, ndesc
+_USBMON_HEADER = struct.Struct('<QBBBBHBBqiiII8siiII')
+
+
+class USBmonTransfer(Enum):
+    """
+    usbmon's transfer types, which are numbered differently to USB's.
+    """
+    ISO = 0
+    INTERRUPT = 1
+    CONTROL = 2
+    BULK = 3
+
+    @classmethod
+    def from_attributes(cls, bm_attributes):
+        """
+        The transfer type for an endpoint descriptor's bmAttributes.
+        """
+        return (cls.CONTROL, cls.ISO, cls.BULK, cls.INTERRUPT)[
+            bm_attributes & 0x03
+        ]
+
+
+# flag_setup when there is no setup packet, and flag_data when a submission
+# has no data because it is an IN transfer, or a completion because it is
+# an OUT one.
+NO_SETUP = ord('-')
+NO_DATA_IN = ord('<')
+NO_DATA_OUT = ord('>')
+
+EINPROGRESS = -115
+
+
+class USBmonWriter:
+    """
+    Writes URB submissions and completions to a pcap file.
+
+    Payloads are truncated to `snaplen`, with the full length still noted in
+    the record, so capturing large transfers stays cheap.
+    """
+
+    def __init__(self, file, snaplen=0xffff):
+        self.file = file
+        self.snaplen = snaplen
+        self.file.write(_PCAP_HEADER.pack(
+            0xa1b2c3d4, 2, 4, 0, 0, USBMON_HEADER_LENGTH + snaplen,
+            LINKTYPE_USB_LINUX_MMAPPED
+        ))
+
+    @classmethod
+    def open(cls, path, snaplen=0xffff):
+        return cls(open(path, 'wb'), snaplen)
+
+    def record(self, urb_id, event, transfer, endpoint, devnum, busnum,
+               status, length, setup=None, data=b'', flag_data=0):
+        """
+        Write one event, 'S' for a submission or 'C' for a completion.
+
+        `endpoint` includes the direction bit, and `length` is the full
+        length of the transfer, of which `data` is what is to be captured.
+        """
+        now = time.time()
+        ts_sec = int(now)
+        ts_usec = int((now - ts_sec) * 1e6)
+
+        data = data[:self.snaplen]
+        header = _USBMON_HEADER.pack(
+            urb_id, ord(event), transfer.value, endpoint, devnum, busnum,
+            NO_SETUP if setup is None else 0,
+            flag_data if not data else 0,
+            ts_sec, ts_usec, status, length, len(data),
+            bytes(8) if setup is None else bytes(setup), 0, 0, 0, 0
+        )
+        self.file.write(_PCAP_RECORD.pack(
+            ts_sec, ts_usec, len(header) + len(data),
+            len(header) + length
+        ))
+        self.file.write(header)
+        if data:
+            self.file.write(data)
+
+    def flush(self):
+        self.file.flush()
+
+    def close(self):
+        self.file.close()
@@ -13,8 +13,20 @@ class StandardRequestID(Enum):
     SET_CONFIGURATION = 0x09
 
     GET_INTERFACE = 0x0a
-    SET_INTERFACE = 0x11
+    SET_INTERFACE = 0x0b
 
-    SYNCH_FRAME = 0x12
+    SYNCH_FRAME = 0x0c
 
+
+class HIDRequestID(Enum):
+    """
+    HID class requests, which reuse the standard request numbers.
+
+    "Device Class Definition for Human Interface Devices (HID)", 7.2
+    """
+    GET_REPORT = 0x01
+    GET_IDLE = 0x02
+    GET_PROTOCOL = 0x03
+    SET_REPORT = 0x09
     SET_IDLE = 0x0a
+    SET_PROTOCOL = 0x0b
@@ -1,19 +1,51 @@
 import struct
+from functools import lru_cache
 from .enum import \
         Recipient, \
         Type, \
         TransferDirection, \
         FeatureSelector, \
-        StandardRequestID as Request
-from device.descriptors import DescriptorTypes
+        StandardRequestID as Request, \
+        HIDRequestID as HIDRequest, \
+        DescriptorTypes
 
 
 class RequestType:
     def __init__(self, data):
-        values = bin(data)[2:]
-        self.recipient = Recipient(int(values[0:4][::-1], 2))
-        self.type = Type(int(values[4:6][::-1], 2))
-        self.transfer_direction = TransferDirection(int(values[7], 2))
+        self.recipient = Recipient(data & 0x1f)
+        self.type = Type((data >> 5) & 0x03)
+        self.transfer_direction = TransferDirection(data >> 7)
+
+
+def request_type(direction, type, recipient):
+    """
+    bmRequestType for a request, from the parts RequestType splits it into.
+    """
+    return direction.value << 7 | type.value << 5 | recipient.value
+
+
+# The requests bRequest is decoded as, by the type in bmRequestType. HID is
+# the only class handled, so class requests are taken to be HID ones.
+_REQUEST_IDS = {
+    Type.STANDARD.value: Request,
+    Type.CLASS.value: HIDRequest
+}
+
+_SETUP = struct.Struct('<BBHHH')
+
+
+def request_id(bmRequestType, bRequest):
+    """
+    The enum member for bRequest, or the number itself for requests that
+    aren't known, such as vendor ones.
+    """
+    request_ids = _REQUEST_IDS.get((bmRequestType >> 5) & 0x03)
+    if request_ids is None:
+        return bRequest
+    try:
+        return request_ids(bRequest)
+    except ValueError:
+        return bRequest
 
 
 class USBSetup:
@@ -26,12 +58,19 @@ class USBSetup:
     def __init__(self, setup_data):
         self.bytes = setup_data
         bmRequestType, bRequest, wValue, wIndex, wLength \
-            = struct.unpack('<BBHHH', setup_data)
+            = _SETUP.unpack(setup_data)
         self._bmRequestType = bmRequestType
-        self._bRequest = Request(bRequest)
+        self._bRequest = request_id(bmRequestType, bRequest)
         self._wValue = wValue
         self._wIndex = wIndex
         self._wLength = wLength
+        self._request = (bmRequestType, bRequest)
+
+    def request(self):
+        """
+        (bmRequestType, bRequest) as numbers, whatever bRequest decodes to.
+        """
+        return self._request
 
     def bmRequestType(self):
         return self._bmRequestType
@@ -223,54 +262,74 @@ class SetIdle(USBSetup):
         return self.wIndex()
 
 
+# (bmRequestType, bRequest) -> the class for that request, and the wValue,
+# wIndex and wLength it has to have, None being anything.
+_SETUP_CLASSES = {
+    # Standard Device Requests
+    (0b10000000, Request.GET_STATUS.value): (DeviceGetStatus, 0, 0, 2),
+    (0b00000000, Request.CLEAR_FEATURE.value):
+        (DeviceClearFeature, None, 0, 0),
+    (0b00000000, Request.SET_FEATURE.value): (DeviceSetFeature, None, 0, 0),
+    (0b00000000, Request.SET_ADDRESS.value): (DeviceSetAddress, None, 0, 0),
+    (0b10000000, Request.GET_DESCRIPTOR.value):
+        (DeviceGetDescriptor, None, None, None),
+    (0b00000000, Request.SET_DESCRIPTOR.value):
+        (DeviceSetDescriptor, None, None, None),
+    (0b10000000, Request.GET_CONFIGURATION.value):
+        (DeviceGetConfiguration, 0, 0, 1),
+    (0b00000000, Request.SET_CONFIGURATION.value):
+        (DeviceSetConfiguration, None, 0, 0),
+    # Standard Interface Requests
+    (0b10000001, Request.GET_STATUS.value): (InterfaceGetStatus, 0, None, 2),
+    (0b00000001, Request.CLEAR_FEATURE.value):
+        (InterfaceClearFeature, None, None, 0),
+    (0b00000001, Request.SET_FEATURE.value):
+        (InterfaceSetFeature, None, None, 0),
+    (0b10000001, Request.GET_INTERFACE.value):
+        (InterfaceGetInterface, 0, None, 1),
+    (0b00000001, Request.SET_INTERFACE.value):
+        (InterfaceSetInterface, None, None, 0),
+    # Standard Endpoint Requests
+    (0b10000010, Request.GET_STATUS.value): (EndpointGetStatus, 0, None, 2),
+    (0b00000010, Request.CLEAR_FEATURE.value):
+        (EndpointClearFeature, None, None, 0),
+    (0b00000010, Request.SET_FEATURE.value):
+        (EndpointSetFeature, None, None, 0),
+    (0b10000010, Request.SYNCH_FRAME.value):
+        (EndpointSynchFrame, 0, None, 2),
+    # HID
+    (0b10000001, Request.GET_DESCRIPTOR.value):
+        (HIDReport, None, None, None),
+    (0b00100001, HIDRequest.SET_IDLE.value): (SetIdle, None, None, None)
+}
+
+# Distinct setups kept parsed. Hosts repeat the same few dozen, so this only
+# has to be big enough for a handful of devices' worth.
+SETUP_CACHE_SIZE = 512
+
+
+@lru_cache(maxsize=SETUP_CACHE_SIZE)
+def _parse_setup(setup_data):
+    bmRequestType, bRequest, wValue, wIndex, wLength = \
+        _SETUP.unpack(setup_data)
+
+    entry = _SETUP_CLASSES.get((bmRequestType, bRequest))
+    if entry is None:
+        return USBSetup(setup_data)
+
+    cls, want_wValue, want_wIndex, want_wLength = entry
+    if (want_wValue is None or want_wValue == wValue) and \
+            (want_wIndex is None or want_wIndex == wIndex) and \
+            (want_wLength is None or want_wLength == wLength):
+        return cls(setup_data)
+    return USBSetup(setup_data)
+
+
 def process_USB_setup(setup_data):
     """
     Return the class representing the correct USB Setup request.
+
+    Parsed setups are shared between every packet with the same 8 bytes, so
+    they must not be modified.
     """
-    setup = USBSetup(setup_data)
-
-    resp = setup
-
-    # See if it matches a standard Message type, if so, return that instead.
-    standard_packets = [
-        # Standard Device Requests
-        ((0b10000000, Request.GET_STATUS, 0, 0, 2), DeviceGetStatus),
-        ((0b00000000, Request.CLEAR_FEATURE, None, 0, 0), DeviceClearFeature),
-        ((0b00000000, Request.SET_FEATURE, None, 0, 0), DeviceSetFeature),
-        ((0b00000000, Request.SET_ADDRESS, None, 0, 0), DeviceSetAddress),
-        ((0b10000000, Request.GET_DESCRIPTOR, None, None, None),
-            DeviceGetDescriptor),
-        ((0b00000000, Request.SET_DESCRIPTOR, None, None, None),
-            DeviceSetDescriptor),
-        ((0b10000000, Request.GET_CONFIGURATION, 0, 0, 1),
-            DeviceGetConfiguration),
-        ((0b00000000, Request.SET_CONFIGURATION, None, 0, 0),
-            DeviceSetConfiguration),
-        # Standard Interface Requests
-        ((0b10000001, Request.GET_STATUS, 0, None, 2), InterfaceGetStatus),
-        ((0b00000001, Request.CLEAR_FEATURE, None, None, 0),
-            InterfaceClearFeature),
-        ((0b00000001, Request.SET_FEATURE, None, None, 0),
-            InterfaceSetFeature),
-        ((0b10000001, Request.GET_INTERFACE, 0, None, 1),
-            InterfaceGetInterface),
-        ((0b00000001, Request.SET_INTERFACE, None, None, 0),
-            InterfaceSetInterface),
-        # Standard Endpoint Requests
-        ((0b10000010, Request.GET_STATUS, 0, None, 2), EndpointGetStatus),
-        ((0b00000010, Request.CLEAR_FEATURE, None, None, 0),
-            EndpointClearFeature),
-        ((0b00000010, Request.SET_FEATURE, None, None, 0), EndpointSetFeature),
-        ((0b10000010, Request.SYNCH_FRAME, 0, None, 2), EndpointSynchFrame),
-        # HID
-        ((0b10000001, Request.GET_DESCRIPTOR, None, None, None), HIDReport),
-        ((0b00100001, Request.SET_IDLE, None, None, None), SetIdle)
-    ]
-
-    for standard_packet, type in standard_packets:
-        if setup.match(standard_packet[0], standard_packet[1],
-                       standard_packet[2], standard_packet[3],
-                       standard_packet[4]):
-            return type(setup_data)
-
-    return resp
+    return _parse_setup(bytes(setup_data))
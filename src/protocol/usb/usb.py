@@ -8,8 +8,29 @@ from .setup import process_USB_setup
 
 
 class USBPacket:
+    """
+    A transfer, with its setup packet kept as the raw 8 bytes until
+    something asks for `setup`, as most packets from a capture never get
+    looked at.
+    """
+    __slots__ = ('xfer_type', 'endpoint', 'raw_setup', 'payload', '_setup')
+
     def __init__(self, xfer_type, endpoint, setup, payload):
         self.xfer_type = xfer_type
         self.endpoint = endpoint
-        self.setup = process_USB_setup(setup)
+        self.raw_setup = setup
         self.payload = payload
+        self._setup = None
+
+    @property
+    def setup(self):
+        """
+        The setup packet, decoded into the class for its request.
+        """
+        if self._setup is None:
+            self._setup = process_USB_setup(self.raw_setup)
+        return self._setup
+
+    @setup.setter
+    def setup(self, setup):
+        self._setup = setup
@@ -1 +1,8 @@
 from .server import USBIPServer
+from .aio import AsyncioUSBIPServer
+
+# Servers for the --engine option.
+ENGINES = {
+    'twisted': USBIPServer,
+    'asyncio': AsyncioUSBIPServer
+}
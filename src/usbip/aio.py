@@ -0,0 +1,204 @@
+"""
+asyncio based server, as an alternative to the Twisted one.
+
+Drives the same `USBIPSession`, so devices and the `DeviceList` work the same
+way under either, and it can be embedded in an existing asyncio application
+with `await AsyncioUSBIPServer(...).listen()`.
+"""
+import asyncio
+import logging
+import socket
+from twisted.internet import defer
+
+from .connections import Connections
+from .listen import tcp_address, remove_stale_socket
+from .session import USBIPSession
+from .sockopt import set_keepalive
+
+
+class AsyncioDelayedCall:
+    """
+    Wraps an asyncio TimerHandle to look like Twisted's IDelayedCall.
+    """
+
+    def __init__(self, loop, delay, f, args, kwargs):
+        self.called = False
+        self.cancelled = False
+        self._f = f
+        self._args = args
+        self._kwargs = kwargs
+        self._handle = loop.call_later(delay, self._run)
+
+    def _run(self):
+        self.called = True
+        self._f(*self._args, **self._kwargs)
+
+    def active(self):
+        return not (self.called or self.cancelled)
+
+    def cancel(self):
+        self.cancelled = True
+        self._handle.cancel()
+
+
+class AsyncioClock:
+    """
+    The parts of Twisted's IReactorTime used by the session and
+    `Deferred.addTimeout`, on top of an asyncio loop.
+    """
+
+    def __init__(self, loop):
+        self.loop = loop
+
+    def seconds(self):
+        return self.loop.time()
+
+    def callLater(self, delay, f, *args, **kwargs):
+        return AsyncioDelayedCall(self.loop, delay, f, args, kwargs)
+
+
+class AsyncioUSBIP(asyncio.BufferedProtocol):
+    """
+    asyncio side of a USBIP connection, see `USBIPSession` for the protocol
+    itself and the options it takes.
+
+    Reads go straight into the session's receive buffer, and the transport
+    pauses the session when its write buffer fills.
+    """
+
+    def __init__(self, devlist, loop, clock=None, **options):
+        self.loop = loop
+        self.transport = None
+        self.session = USBIPSession(
+            devlist, self, clock or AsyncioClock(loop), **options
+        )
+
+    def connection_made(self, transport):
+        self.transport = transport
+        self.session.connection_made()
+
+    def connection_lost(self, exc):
+        self.session.connection_lost()
+
+    def get_buffer(self, sizehint):
+        return self.session.framer.get_buffer(sizehint)
+
+    def buffer_updated(self, nbytes):
+        self.session.buffer_updated(nbytes)
+
+    def pause_writing(self):
+        self.session.pause_producing()
+
+    def resume_writing(self):
+        self.session.resume_producing()
+
+    def eof_received(self):
+        # Let the transport close itself.
+        return False
+
+    # The link used by the session.
+
+    def send(self, segments):
+        self.transport.writelines(segments)
+
+    def close(self):
+        self.transport.close()
+
+    def _tcp_socket(self):
+        sock = self.transport.get_extra_info('socket')
+        if sock is None or \
+                sock.family not in (socket.AF_INET, socket.AF_INET6):
+            return None
+        return sock
+
+    def set_nodelay(self, value):
+        sock = self._tcp_socket()
+        if sock is not None:
+            sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, int(value))
+
+    def set_cork(self, value):
+        sock = self._tcp_socket()
+        if sock is not None and hasattr(socket, 'TCP_CORK'):
+            sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_CORK, int(value))
+
+    def set_keepalive(self, idle):
+        sock = self._tcp_socket()
+        if sock is not None:
+            set_keepalive(sock, idle)
+
+    def set_write_limits(self, high, low):
+        self.transport.set_write_buffer_limits(high, low)
+
+    def buffered(self):
+        return self.transport.get_write_buffer_size()
+
+    def pause_reading(self):
+        self.transport.pause_reading()
+
+    def resume_reading(self):
+        self.transport.resume_reading()
+
+    def abort(self):
+        self.transport.abort()
+
+    def as_deferred(self, result):
+        if isinstance(result, defer.Deferred):
+            return result
+        # Coroutines run as tasks on this loop, not through Twisted.
+        return defer.Deferred.fromFuture(
+            asyncio.ensure_future(result, loop=self.loop)
+        )
+
+
+class AsyncioUSBIPServer:
+    """
+    Wrapper around asyncio Servers, taking the same arguments as
+    `USBIPServer`.
+    """
+
+    def __init__(self, host, port, device_list, reuse_port=False,
+                 listen=None, **options):
+        self.addresses = listen or [tcp_address(host, port)]
+        self.devlist = device_list
+        self.reuse_port = reuse_port
+        self.connections = Connections()
+        self.options = {'connections': self.connections, **options}
+        self.servers = []
+
+    def protocol(self):
+        loop = asyncio.get_running_loop()
+        return AsyncioUSBIP(self.devlist, loop, **self.options)
+
+    async def listen(self):
+        """
+        Start listening on the running loop, returning an asyncio Server for
+        each address.
+        """
+        loop = asyncio.get_running_loop()
+        for address in self.addresses:
+            if address.kind == 'unix':
+                remove_stale_socket(address.path)
+                server = await loop.create_unix_server(
+                    self.protocol, address.path
+                )
+            else:
+                server = await loop.create_server(
+                    self.protocol, address.host, address.port,
+                    reuse_port=self.reuse_port or None
+                )
+            self.servers.append(server)
+        return self.servers
+
+    async def serve(self):
+        servers = await self.listen()
+        try:
+            await asyncio.gather(
+                *(server.serve_forever() for server in servers)
+            )
+        finally:
+            for server in servers:
+                server.close()
+
+    def start(self):
+        logging.info('Starting Server')
+        asyncio.run(self.serve())
@@ -0,0 +1,290 @@
+"""
+asyncio USBIP client.
+
+Talks to any USBIP server, so the server can be driven without the kernel's
+`usbip` tool and vhci-hcd:
+
+    client = await USBIPClient.connect(tcp_address('127.0.0.1', 3240))
+    await client.import_device('1-1')
+    reply = await client.control(bytes.fromhex('8006000100001200'))
+
+URBs are pipelined, `submit()` sends straight away and returns a future for
+the reply, and replies are matched up by seqnum in whatever order the server
+completes them.
+"""
+import asyncio
+import logging
+
+from .exceptions import ParseError, VersionError
+from .framer import USBIPFramer
+from .listen import tcp_address, unix_address
+from .message import \
+        op_reply_length, \
+        pack_op_request, \
+        USBIPCommands, \
+        USBIPServerMessage
+from .usbip import \
+        pack_cmd_submit, \
+        pack_cmd_unlink, \
+        ret_length, \
+        USBIPDirection, \
+        USBIPReply, \
+        USBIPUnlinkStatus
+
+USBIP_PORT = 3240
+
+
+def parse_server(description):
+    """
+    Parse the address of a server to connect to, `HOST[:PORT]` or
+    `unix:PATH`, raising ValueError if it isn't one.
+    """
+    if description.startswith('unix:'):
+        return unix_address(description[len('unix:'):])
+    host, _, port = description.partition(':')
+    if not host or (port and not port.isdigit()):
+        raise ValueError(f'{description} is not HOST[:PORT] or unix:PATH')
+    return tcp_address(host, int(port or USBIP_PORT))
+
+
+async def open_connection(address, factory):
+    """
+    Connect to the server at `address`, a `ListenAddress`, returning the
+    transport and protocol like `loop.create_connection()`.
+    """
+    loop = asyncio.get_running_loop()
+    if address.kind == 'unix':
+        return await loop.create_unix_connection(factory, address.path)
+    return await loop.create_connection(factory, address.host, address.port)
+
+
+class USBIPClient(asyncio.BufferedProtocol):
+    """
+    Client side of a USBIP connection.
+
+    Like the kernel's client, a connection is used either for a single
+    devlist request, or to import a device and then submit URBs to it.
+    """
+
+    def __init__(self):
+        self.transport = None
+        self.framer = USBIPFramer(op_reply_length)
+        self.devid = None
+        self.closed = asyncio.get_running_loop().create_future()
+        # Future for the OP_REP_* being waited on.
+        self._op = None
+        # seqnum -> (direction, future) for the URBs in flight.
+        self._pending = {}
+        # seqnum of a CMD_UNLINK -> the seqnum it unlinks.
+        self._unlinks = {}
+        self._seqnum = 0
+        self._writable = None
+
+    @classmethod
+    async def connect(cls, address):
+        _, client = await open_connection(address, cls)
+        return client
+
+    def connection_made(self, transport):
+        self.transport = transport
+
+    def connection_lost(self, exc):
+        error = exc or ConnectionError('The server closed the connection')
+        if self._op is not None and not self._op.done():
+            self._op.set_exception(error)
+        for _, future in self._pending.values():
+            if not future.done():
+                future.set_exception(error)
+        self._pending.clear()
+        if self._writable is not None and not self._writable.done():
+            self._writable.set_result(None)
+        if not self.closed.done():
+            self.closed.set_result(None)
+
+    def get_buffer(self, sizehint):
+        return self.framer.get_buffer(sizehint)
+
+    def buffer_updated(self, nbytes):
+        messages = self.framer.buffer_updated(nbytes)
+        try:
+            for message in messages:
+                if self.devid is None:
+                    self._op_reply(message)
+                else:
+                    self._reply(USBIPReply(message))
+        except (ParseError, VersionError) as e:
+            logging.error(str(e))
+            messages.close()
+            self.transport.abort()
+
+    def pause_writing(self):
+        self._writable = asyncio.get_running_loop().create_future()
+
+    def resume_writing(self):
+        if self._writable is not None and not self._writable.done():
+            self._writable.set_result(None)
+        self._writable = None
+
+    def eof_received(self):
+        return False
+
+    async def drain(self):
+        """
+        Wait until the transport's write buffer is below its high watermark,
+        for generating load without buffering it all in the client.
+        """
+        if self._writable is not None:
+            await self._writable
+
+    def close(self):
+        self.transport.close()
+
+    # OP phase.
+
+    def _op_reply(self, message):
+        reply = USBIPServerMessage(message)
+        if self._op is not None and not self._op.done():
+            self._op.set_result(reply)
+
+    async def _request(self, cc, busid=None):
+        self._op = asyncio.get_running_loop().create_future()
+        self.transport.write(pack_op_request(cc, busid))
+        return await self._op
+
+    async def list_devices(self):
+        """
+        Send OP_REQ_DEVLIST, returning the device records.
+        """
+        reply = await self._request(USBIPCommands.OP_REQ_DEVLIST)
+        return reply.devices
+
+    async def import_device(self, busid):
+        """
+        Send OP_REQ_IMPORT, returning the device record, or None if the
+        import was refused.
+        """
+        reply = await self._request(USBIPCommands.OP_REQ_IMPORT, busid)
+        if reply.status != 0:
+            return None
+
+        record, = reply.devices
+        self.devid = record.busnum << 16 | record.devnum
+        self.framer.length_function = self._reply_length
+        return record
+
+    # URB phase.
+
+    def _reply_length(self, buffer, offset=0):
+        return ret_length(buffer, offset, self._direction_of)
+
+    def _direction_of(self, seqnum):
+        pending = self._pending.get(seqnum)
+        return pending[0] if pending else None
+
+    def _reply(self, reply):
+        pending = self._pending.pop(reply.seqnum, None)
+        if pending is None:
+            return
+        _, future = pending
+
+        unlinked = self._unlinks.pop(reply.seqnum, None)
+        if unlinked is not None and reply.status == \
+                USBIPUnlinkStatus.SUCCESS.value:
+            # The URB was unlinked before it completed, so it never gets a
+            # RET_SUBMIT of its own.
+            _, urb = self._pending.pop(unlinked, (None, None))
+            if urb is not None:
+                urb.cancel()
+
+        if not future.done():
+            future.set_result(reply)
+
+    def _next_seqnum(self):
+        self._seqnum = (self._seqnum + 1) & 0xffffffff or 1
+        return self._seqnum
+
+    def _cmd_submit(self, ep=0, direction=USBIPDirection.USBIP_DIR_IN,
+                    setup=bytes(8), data=b'', length=None, **fields):
+        if self.devid is None:
+            raise RuntimeError('No device has been imported')
+
+        seqnum = self._next_seqnum()
+        if length is None:
+            length = len(data)
+        future = asyncio.get_running_loop().create_future()
+        future.seqnum = seqnum
+        self._pending[seqnum] = (direction, future)
+        header = pack_cmd_submit(
+            seqnum, self.devid, direction, ep, length, setup, **fields
+        )
+        return future, header, data
+
+    def submit(self, **urb):
+        """
+        Send a CMD_SUBMIT, returning a future for its USBIPReply.
+
+        Takes `ep`, `direction`, `setup`, `data` and `length`, which defaults
+        to the size of `data`, and any other fields are passed on to
+        `pack_cmd_submit()`. The future's `seqnum` is the URB's, for
+        `unlink()`, and it is cancelled if the URB is unlinked.
+        """
+        future, header, data = self._cmd_submit(**urb)
+        if data:
+            self.transport.writelines((header, data))
+        else:
+            self.transport.write(header)
+        return future
+
+    def submit_all(self, urbs):
+        """
+        Send a batch of CMD_SUBMITs in a single write, returning a future for
+        each of their replies.
+        """
+        futures = []
+        segments = []
+        for urb in urbs:
+            future, header, data = self._cmd_submit(**urb)
+            futures.append(future)
+            segments.append(header)
+            if data:
+                segments.append(data)
+        self.transport.writelines(segments)
+        return futures
+
+    async def control(self, setup, data=b''):
+        """
+        Do a control transfer on endpoint 0, returning the reply. The
+        direction and length come from the setup packet.
+        """
+        setup = bytes(setup)
+        direction = USBIPDirection.USBIP_DIR_IN if setup[0] & 0x80 \
+            else USBIPDirection.USBIP_DIR_OUT
+        w_length = int.from_bytes(setup[6:8], 'little')
+        return await self.submit(
+            direction=direction, setup=setup, data=data, length=w_length
+        )
+
+    def unlink(self, seqnum):
+        """
+        Send a CMD_UNLINK for the URB with `seqnum`, returning a future for
+        the RET_UNLINK.
+        """
+        unlink_seqnum = self._next_seqnum()
+        future = asyncio.get_running_loop().create_future()
+        self._pending[unlink_seqnum] = (USBIPDirection.USBIP_DIR_OUT, future)
+        self._unlinks[unlink_seqnum] = seqnum
+        self.transport.write(
+            pack_cmd_unlink(unlink_seqnum, self.devid, seqnum)
+        )
+        return future
+
+
+async def list_devices(address):
+    """
+    List the devices exported by the server at `address`.
+    """
+    client = await USBIPClient.connect(address)
+    try:
+        return await client.list_devices()
+    finally:
+        client.close()
@@ -0,0 +1,50 @@
+"""
+Tracking of the open connections to a server.
+"""
+import logging
+
+
+class Connections:
+    """
+    The sessions currently connected to a server, so what each is holding
+    can be looked at while it runs.
+
+    Sessions add themselves when they connect and remove themselves once
+    they have torn down, logging what they used.
+    """
+
+    def __init__(self):
+        self._sessions = set()
+        self.opened = 0
+        self.closed = 0
+
+    def add(self, session):
+        self._sessions.add(session)
+        self.opened += 1
+
+    def remove(self, session):
+        if session not in self._sessions:
+            return
+        self._sessions.discard(session)
+        self.closed += 1
+        logging.info(f'Connection closed, used {session.resources()}')
+
+    def __len__(self):
+        return len(self._sessions)
+
+    def __iter__(self):
+        return iter(self._sessions)
+
+    def resources(self):
+        """
+        The resources of every open connection, added together (or the
+        largest, for maximums).
+        """
+        totals = {}
+        for session in self._sessions:
+            for key, value in session.resources().items():
+                if key.endswith('_max'):
+                    totals[key] = max(totals.get(key, 0), value)
+                else:
+                    totals[key] = totals.get(key, 0) + value
+        return totals
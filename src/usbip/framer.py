@@ -0,0 +1,159 @@
+"""
+Incremental framing of the USBIP byte stream.
+
+TCP gives us no message boundaries, so a single read can contain several
+messages (the host pipelines CMD_SUBMITs) or only part of one (large OUT
+transfers).
+"""
+from .exceptions import ParseError
+
+
+class USBIPFramer:
+    """
+    Splits a stream of reads into complete messages.
+
+    `length_function` is called with a buffer and an offset, and returns the
+    length of the message starting there, or None if not enough of it has
+    arrived to tell yet. It can be swapped at any point, which is how the
+    protocol moves from the OP_* messages to the URB ones.
+
+    With `max_length`, a message declaring itself longer than that raises
+    ParseError as soon as its header arrives, rather than being buffered.
+    """
+
+    # Initial size of the buffer used by get_buffer(), it grows to fit larger
+    # messages, and the least space to offer for each read.
+    READ_SIZE = 0x10000
+    MIN_READ = 0x1000
+
+    def __init__(self, length_function, max_length=None):
+        self.length_function = length_function
+        self.max_length = max_length
+        self._buffer = bytearray()
+        # Receive buffer for get_buffer(), with the unprocessed data in
+        # _rbuf[_start:_end].
+        self._rbuf = None
+        self._start = 0
+        self._end = 0
+
+    def _length(self, buffer, offset):
+        length = self.length_function(buffer, offset)
+        if length is not None and self.max_length is not None and \
+                length > self.max_length:
+            raise ParseError(
+                f'Message of {length} bytes is over the limit of '
+                f'{self.max_length}'
+            )
+        return length
+
+    def pending(self):
+        """
+        Number of bytes buffered waiting for the rest of a message.
+        """
+        return len(self._buffer) + self._end - self._start
+
+    def clear(self):
+        self._buffer.clear()
+        self._start = self._end = 0
+
+    def detach(self):
+        """
+        Take everything buffered by `feed()` that hasn't been yielded yet,
+        for handing the rest of the stream on to something else.
+        """
+        data = bytes(self._buffer)
+        self._buffer.clear()
+        return data
+
+    def feed(self, data):
+        """
+        Add data from the transport, yielding every complete message.
+
+        Messages are memoryviews over immutable bytes, so it is safe to hold
+        onto them after the next read.
+        """
+        if self._buffer:
+            self._buffer += data
+            # Nothing can be yielded until the message waiting on the rest
+            # of itself is complete, so leave it in the buffer until then.
+            length = self._length(self._buffer, 0)
+            if length is None or length > len(self._buffer):
+                return
+            # Copy the buffer out once so the yielded messages don't pin it.
+            view = memoryview(bytes(self._buffer))
+            self._buffer.clear()
+        else:
+            # Nothing left over from last time, work straight off the read.
+            view = memoryview(data)
+
+        offset = 0
+        try:
+            while offset < len(view):
+                length = self._length(view, offset)
+                if length is None or offset + length > len(view):
+                    break
+                message = view[offset:offset + length]
+                offset += length
+                yield message
+        finally:
+            if offset < len(view):
+                self._buffer += view[offset:]
+
+    def buffered(self):
+        """
+        Yield the complete messages still buffered, for when the caller
+        stopped taking them part way through a read.
+        """
+        if self._end > self._start:
+            return self.buffer_updated(0)
+        return self.feed(b'')
+
+    def get_buffer(self, sizehint=-1):
+        """
+        Return a buffer for the transport to read straight into, for use with
+        asyncio's BufferedProtocol.
+
+        Follow each read with `buffer_updated()`.
+        """
+        size = max(sizehint, self.MIN_READ)
+        if self._rbuf is None:
+            self._rbuf = bytearray(max(size, self.READ_SIZE))
+
+        if len(self._rbuf) - self._end < size:
+            waiting = self._end - self._start
+            if len(self._rbuf) - waiting < size:
+                # The transport may still hold a view of the old buffer, so
+                # never resize it, swap in a bigger one instead.
+                rbuf = bytearray(max(waiting + size, 2 * len(self._rbuf)))
+                rbuf[:waiting] = self._rbuf[self._start:self._end]
+                self._rbuf = rbuf
+            else:
+                # Slide the partial message back to the start.
+                self._rbuf[:waiting] = self._rbuf[self._start:self._end]
+            self._start, self._end = 0, waiting
+
+        return memoryview(self._rbuf)[self._end:]
+
+    def buffer_updated(self, nbytes):
+        """
+        Account for `nbytes` read into the buffer from `get_buffer()`,
+        yielding every complete message.
+
+        The receive buffer is reused, so each message is copied out into its
+        own bytes.
+        """
+        self._end += nbytes
+        try:
+            while self._start < self._end:
+                length = self._length(
+                    memoryview(self._rbuf)[:self._end], self._start
+                )
+                if length is None or self._start + length > self._end:
+                    break
+                end = self._start + length
+                message = memoryview(self._rbuf)[self._start:end].tobytes()
+                self._start = end
+                yield memoryview(message)
+        finally:
+            if self._start == self._end:
+                self._start = self._end = 0
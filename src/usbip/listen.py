@@ -0,0 +1,81 @@
+"""
+Addresses for the servers to listen on.
+
+Uses the same syntax as Twisted's endpoint strings:
+
+* `tcp:PORT` or `tcp:PORT:interface=HOST`
+* `unix:PATH`
+"""
+import errno
+import os
+import socket
+import stat
+from collections import namedtuple
+
+
+ListenAddress = namedtuple('ListenAddress', ['kind', 'host', 'port', 'path'])
+
+
+def tcp_address(host, port):
+    return ListenAddress('tcp', host, port, None)
+
+
+def unix_address(path):
+    return ListenAddress('unix', None, None, path)
+
+
+def parse_address(description):
+    """
+    Parse a listening address, raising ValueError if it isn't one.
+    """
+    kind, _, rest = description.partition(':')
+    match kind:
+        case 'tcp':
+            port, _, interface = rest.partition(':')
+            host = '0.0.0.0'
+            if interface:
+                key, _, host = interface.partition('=')
+                if key != 'interface' or not host:
+                    raise ValueError(f'Unknown TCP option {interface}')
+            return tcp_address(host, int(port))
+        case 'unix':
+            if not rest:
+                raise ValueError('UNIX address needs a path')
+            return unix_address(rest)
+        case _:
+            raise ValueError(f'Unknown address type in {description}')
+
+
+def remove_stale_socket(path):
+    """
+    Remove a UNIX socket left behind by a previous run, so it can be bound
+    again. Anything that isn't a socket is left alone.
+
+    Raises OSError with EADDRINUSE if a server is still listening on it.
+    """
+    try:
+        if not stat.S_ISSOCK(os.stat(path).st_mode):
+            return
+    except FileNotFoundError:
+        return
+
+    probe = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    # A live server with a full backlog would block the connect.
+    probe.settimeout(1)
+    try:
+        probe.connect(path)
+    except ConnectionRefusedError:
+        # Nothing is listening, so it is stale.
+        try:
+            os.unlink(path)
+        except FileNotFoundError:
+            pass
+        return
+    except FileNotFoundError:
+        return
+    except (BlockingIOError, TimeoutError):
+        pass
+    finally:
+        probe.close()
+
+    raise OSError(errno.EADDRINUSE, f'{path} is in use by another server')
@@ -0,0 +1,421 @@
+"""
+In-memory loopback for the USBIP protocol.
+
+Connects a scripted client straight to the `USBIP` protocol through a
+StringTransport, with a fake clock standing in for the reactor, so a device
+can be driven through OP_REQ_DEVLIST, OP_REQ_IMPORT and CMD_SUBMIT without
+any sockets. Nothing happens unless the client makes it, so runs are
+deterministic. `AsyncioLoopbackClient` does the same for `AsyncioUSBIP`.
+
+    client = LoopbackClient(device_list)
+    client.import_device('1-1')
+    reply = client.control(bytes.fromhex('8006000100001200'))
+"""
+import asyncio
+from twisted.internet.error import ConnectionDone
+from twisted.internet.task import Clock
+from twisted.internet.testing import StringTransport
+from twisted.python.failure import Failure
+
+from .aio import AsyncioUSBIP
+from .framer import USBIPFramer
+from .message import \
+        op_reply_length, \
+        pack_op_request, \
+        USBIPCommands, \
+        USBIPServerMessage
+from .server import USBIP
+from .usbip import \
+        pack_cmd_submit, \
+        pack_cmd_unlink, \
+        ret_length, \
+        USBIPDirection, \
+        USBIPReply
+
+
+class LoopbackTransport(StringTransport):
+    """
+    StringTransport with a write buffer that works like a FileDescriptor's.
+
+    What the server writes stays buffered until the client reads it. The
+    registered producer is paused while the buffer is over `bufferSize`, and
+    resumed once the client has emptied it.
+    """
+
+    bufferSize = 0x10000
+    # Read by `USBIP.buffered()`, everything is kept in dataBuffer.
+    offset = 0
+    _tempDataLen = 0
+
+    def __init__(self):
+        # Set first, as StringTransport clears the buffer.
+        self.dataBuffer = bytearray()
+        self.producerPaused = False
+        super().__init__()
+
+    @property
+    def reading_paused(self):
+        return self.producerState == 'paused'
+
+    def write(self, data):
+        if not isinstance(data, bytes):
+            raise TypeError(f'Data must be bytes, not {type(data)}')
+        self.dataBuffer += data
+        if self.producer is not None and not self.producerPaused and \
+                len(self.dataBuffer) > self.bufferSize:
+            self.producerPaused = True
+            self.producer.pauseProducing()
+
+    def writeSequence(self, data):
+        for segment in data:
+            self.write(segment)
+
+    def value(self):
+        return bytes(self.dataBuffer)
+
+    def clear(self):
+        self.dataBuffer.clear()
+
+    def read(self):
+        """
+        Take everything written so far, as the client reading it.
+        """
+        data = self.value()
+        self.clear()
+        if self.producer is not None and self.producerPaused:
+            self.producerPaused = False
+            self.producer.resumeProducing()
+        return data
+
+    def abortConnection(self):
+        # Anything still buffered is thrown away, as on a real connection.
+        self.clear()
+        super().abortConnection()
+
+
+class LoopbackAsyncioTransport(asyncio.Transport):
+    """
+    The asyncio transport used by `AsyncioLoopbackClient`, with a write
+    buffer like `LoopbackTransport`'s.
+
+    The protocol's writing is paused while the buffer is over the high
+    watermark, and resumed once the client has read it down to the low one.
+    """
+
+    def __init__(self, protocol):
+        super().__init__()
+        self.protocol = protocol
+        self.buffer = bytearray()
+        self.high = 0x10000
+        self.low = 0x4000
+        self.writing_paused = False
+        self.reading_paused = False
+        self.disconnecting = False
+
+    def write(self, data):
+        self.buffer += data
+        if not self.writing_paused and len(self.buffer) > self.high:
+            self.writing_paused = True
+            self.protocol.pause_writing()
+
+    def get_write_buffer_size(self):
+        return len(self.buffer)
+
+    def get_write_buffer_limits(self):
+        return self.low, self.high
+
+    def set_write_buffer_limits(self, high=None, low=None):
+        self.high = 0x10000 if high is None else high
+        self.low = self.high // 4 if low is None else low
+
+    def pause_reading(self):
+        self.reading_paused = True
+
+    def resume_reading(self):
+        self.reading_paused = False
+
+    def is_reading(self):
+        return not self.reading_paused
+
+    def close(self):
+        self.disconnecting = True
+
+    def is_closing(self):
+        return self.disconnecting
+
+    def abort(self):
+        self.buffer.clear()
+        self.disconnecting = True
+
+    def read(self):
+        """
+        Take everything written so far, as the client reading it.
+        """
+        data = bytes(self.buffer)
+        self.buffer.clear()
+        if self.writing_paused:
+            self.writing_paused = False
+            self.protocol.resume_writing()
+        return data
+
+
+class LoopbackClient:
+    """
+    A client connected in memory to a USBIP protocol serving `devlist`, which
+    is built with `options` like one from `USBIPFactory`.
+
+    Like a real connection, it is used either for a single devlist request,
+    or to import a device and then submit URBs to it. Replies to URBs are
+    collected in `replies` by seqnum.
+
+    The server's clock only moves when `run()` is called, which is done after
+    every send to flush out the replies. Devices returning Deferreds can be
+    completed between sends, and `run(seconds)` will fire URB timeouts.
+    Clients can share a `clock`, to act like connections to one server.
+
+    Data sent while the server has paused reading waits until it resumes.
+    With `reading` set to False the client stops reading replies, leaving
+    them in the transport's write buffer, until it is set back and `run()`
+    is called.
+    """
+
+    def __init__(self, devlist, clock=None, **options):
+        self.clock = clock or Clock()
+        self.transport, self.protocol = self.connect(devlist, **options)
+        self.framer = USBIPFramer(op_reply_length)
+        self.connected = True
+        self.reading = True
+        self.devid = None
+        self.replies = {}
+        self._directions = {}
+        self._seqnum = 0
+        self._unsent = bytearray()
+
+    def connect(self, devlist, **options):
+        """
+        Connect a server protocol for `devlist`, returning the transport and
+        protocol.
+        """
+        transport = LoopbackTransport()
+        protocol = USBIP(devlist, clock=self.clock, **options)
+        protocol.makeConnection(transport)
+        return transport, protocol
+
+    def receive(self, data):
+        """
+        Have the server read from `data`, returning how much it took.
+        """
+        self.protocol.dataReceived(bytes(data))
+        return len(data)
+
+    def advance(self, seconds):
+        """
+        Move the server's clock on by `seconds`.
+        """
+        self.clock.advance(seconds)
+
+    def disconnect(self):
+        """
+        Tell the server the connection has gone.
+        """
+        self.protocol.connectionLost(Failure(ConnectionDone()))
+
+    def send(self, data):
+        """
+        Hand raw bytes to the server, returning the messages it replied with.
+        """
+        if not self.connected:
+            raise ConnectionError('The server closed the connection')
+        self._unsent += data
+        return self.run()
+
+    def run(self, seconds=0):
+        """
+        Advance the server's clock, returning the messages it wrote.
+
+        Carries on until the server has read everything it can, and the
+        client has read every reply it can.
+        """
+        self.advance(seconds)
+
+        data = bytearray()
+        while self.connected:
+            delivered = self._deliver()
+            self.advance(0)
+            read = self.transport.read() if self.reading else b''
+            data += read
+            if not (delivered or read):
+                break
+
+        messages = list(self.framer.feed(bytes(data)))
+
+        if self.devid is not None:
+            for message in messages:
+                reply = USBIPReply(message)
+                self._directions.pop(reply.seqnum, None)
+                self.replies[reply.seqnum] = reply
+
+        if self.connected and self.transport.disconnecting:
+            self.close()
+
+        return messages
+
+    def _deliver(self):
+        """
+        Hand over what has been sent, for as long as the server is reading,
+        returning whether anything was.
+        """
+        delivered = False
+        while self._unsent and not self.transport.reading_paused:
+            taken = self.receive(self._unsent)
+            del self._unsent[:taken]
+            delivered = True
+        return delivered
+
+    def close(self):
+        self.connected = False
+        self.disconnect()
+
+    def list_devices(self):
+        """
+        Send OP_REQ_DEVLIST, returning the device records.
+        """
+        messages = self.send(pack_op_request(USBIPCommands.OP_REQ_DEVLIST))
+        return USBIPServerMessage(messages[0]).devices
+
+    def import_device(self, busid):
+        """
+        Send OP_REQ_IMPORT, returning the device record, or None if the
+        import was refused.
+        """
+        messages = self.send(
+            pack_op_request(USBIPCommands.OP_REQ_IMPORT, busid)
+        )
+        reply = USBIPServerMessage(messages[0])
+        if reply.status != 0:
+            return None
+
+        record, = reply.devices
+        self.devid = record.busnum << 16 | record.devnum
+        self.framer.length_function = self._reply_length
+        return record
+
+    def _reply_length(self, buffer, offset=0):
+        return ret_length(buffer, offset, self._directions.get)
+
+    def _next_seqnum(self):
+        self._seqnum += 1
+        return self._seqnum
+
+    def cmd_submit(self, ep=0, direction=USBIPDirection.USBIP_DIR_IN,
+                   setup=bytes(8), data=b'', length=None, **fields):
+        """
+        Build a CMD_SUBMIT for the imported device, returning its seqnum and
+        the message. `length` defaults to the size of `data`, and any other
+        fields are passed on to `pack_cmd_submit()`.
+        """
+        seqnum = self._next_seqnum()
+        if length is None:
+            length = len(data)
+        self._directions[seqnum] = direction
+        message = pack_cmd_submit(
+            seqnum, self.devid, direction, ep, length, setup, data, **fields
+        )
+        return seqnum, message
+
+    def submit(self, **urb):
+        """
+        Send a single CMD_SUBMIT, taking the same arguments as
+        `cmd_submit()`, and return its seqnum.
+        """
+        seqnum, message = self.cmd_submit(**urb)
+        self.send(message)
+        return seqnum
+
+    def submit_all(self, urbs):
+        """
+        Send a stream of CMD_SUBMITs in one go, as a host with several URBs
+        queued would, returning their seqnums.
+        """
+        seqnums, messages = zip(*(self.cmd_submit(**urb) for urb in urbs))
+        self.send(b''.join(messages))
+        return list(seqnums)
+
+    def control(self, setup, data=b''):
+        """
+        Do a control transfer on endpoint 0, returning the reply if the
+        device completed it straight away.
+
+        The direction and length come from the setup packet.
+        """
+        setup = bytes(setup)
+        direction = USBIPDirection.USBIP_DIR_IN if setup[0] & 0x80 \
+            else USBIPDirection.USBIP_DIR_OUT
+        w_length = int.from_bytes(setup[6:8], 'little')
+        seqnum = self.submit(
+            direction=direction, setup=setup, data=data, length=w_length
+        )
+        return self.replies.pop(seqnum, None)
+
+    def unlink(self, seqnum):
+        """
+        Send a CMD_UNLINK for `seqnum`, returning the unlink's own seqnum.
+        """
+        unlink_seqnum = self._next_seqnum()
+        self.send(pack_cmd_unlink(unlink_seqnum, self.devid, seqnum))
+        return unlink_seqnum
+
+
+class AsyncioLoopbackClient(LoopbackClient):
+    """
+    `LoopbackClient` for the asyncio engine.
+
+    The session still runs on the fake clock, but coroutines returned by
+    devices are run as tasks on `loop`, which is stepped every time the
+    clock is. Reads go through the protocol's buffer, `read_size` bytes at
+    a time at most.
+    """
+
+    def __init__(self, devlist, clock=None, loop=None, read_size=0x10000,
+                 **options):
+        self._own_loop = loop is None
+        self.loop = loop or asyncio.new_event_loop()
+        self.read_size = read_size
+        super().__init__(devlist, clock, **options)
+
+    def connect(self, devlist, **options):
+        protocol = AsyncioUSBIP(
+            devlist, self.loop, clock=self.clock, **options
+        )
+        transport = LoopbackAsyncioTransport(protocol)
+        protocol.connection_made(transport)
+        return transport, protocol
+
+    def receive(self, data):
+        size = min(len(data), self.read_size)
+        buffer = self.protocol.get_buffer(size)
+        size = min(size, len(buffer))
+        buffer[:size] = data[:size]
+        self.protocol.buffer_updated(size)
+        return size
+
+    def advance(self, seconds):
+        super().advance(seconds)
+        # Finishing a task schedules its callbacks for the loop's next pass,
+        # and those can schedule calls on the clock, so go back and forth
+        # until neither has anything left to do. asyncio has no public way
+        # to ask if anything is ready.
+        while self.loop._ready:
+            self.loop.call_soon(self.loop.stop)
+            self.loop.run_forever()
+            self.clock.advance(0)
+
+    def close(self):
+        super().close()
+        # Let tasks cancelled by the disconnect see it.
+        self.advance(0)
+        if self._own_loop:
+            self.loop.close()
+
+    def disconnect(self):
+        self.protocol.connection_lost(None)
@@ -4,6 +4,7 @@ Implementation of the USBIP message format.
 https://docs.kernel.org/usb/usbip_protocol.html
 """
 import struct
+from collections import namedtuple
 from enum import Enum
 from .exceptions import ParseError, VersionError
 
@@ -24,6 +25,26 @@ class USBIPCommands(Enum):
     OP_REP_IMPORT = 0x0003
 
 
+OP_HEADER_LENGTH = 8
+BUSID_LENGTH = 32
+
+
+def op_request_length(buffer, offset=0):
+    """
+    Length of the OP_REQ_* message starting at offset, or None if the header
+    hasn't fully arrived yet.
+    """
+    if len(buffer) - offset < OP_HEADER_LENGTH:
+        return None
+
+    _, cc = struct.unpack_from('>HH', buffer, offset)
+    if cc == USBIPCommands.OP_REQ_IMPORT.value:
+        return OP_HEADER_LENGTH + BUSID_LENGTH
+
+    # OP_REQ_DEVLIST, and anything we don't know is just the header.
+    return OP_HEADER_LENGTH
+
+
 class USBIPClientMessage:
     """
     Client Message Format for the OP_REQ_* messages.
@@ -33,8 +54,11 @@ class USBIPClientMessage:
         try:
             version, cc, status = struct.unpack('>HHI', data[:8])
             self.version = version
-            self.cc = USBIPCommands(cc)
             self.status = status
+            try:
+                self.cc = USBIPCommands(cc)
+            except ValueError:
+                raise ParseError(f'Unknown command {cc:#x}')
 
             if self.version != USBIP_VERSION:
                 raise VersionError(
@@ -56,101 +80,225 @@ def fake_path(busid):
     return f'/dev/fake/{busid}'
 
 
+# path, busid, busnum, devnum, speed, idVendor, idProduct, bcdDevice,
+# bDeviceClass, bDeviceSubClass, bDeviceProtocol, bConfigurationValue,
+# bNumConfigurations, bNumInterfaces
+_DEVICE_RECORD = struct.Struct('>256s32sIIIHHHBBBBBB')
+# bInterfaceClass, bInterfaceSubClass, bInterfaceProtocol, padding
+_INTERFACE_RECORD = struct.Struct('>BBBx')
+_OP_HEADER = struct.Struct('>HHI')
+_DEVLIST_COUNT = struct.Struct('>I')
+DEVICE_RECORD_LENGTH = _DEVICE_RECORD.size
+INTERFACE_RECORD_LENGTH = _INTERFACE_RECORD.size
+
+USBIPDeviceRecord = namedtuple('USBIPDeviceRecord', [
+    'path', 'busid', 'busnum', 'devnum', 'speed', 'idVendor', 'idProduct',
+    'bcdDevice', 'bDeviceClass', 'bDeviceSubClass', 'bDeviceProtocol',
+    'bConfigurationValue', 'bNumConfigurations', 'bNumInterfaces',
+    'interfaces'
+])
+
+
+def pack_op_request(cc, busid=None):
+    """
+    An OP_REQ_* message, as sent by the client.
+    """
+    message = _OP_HEADER.pack(USBIP_VERSION, cc.value, 0)
+    if cc == USBIPCommands.OP_REQ_IMPORT:
+        message += struct.pack('>32s', bytes(busid, 'ascii'))
+    return message
+
+
+def pack_device_record(busnum, devnum, device):
+    """
+    The 312 byte device record, as sent in OP_REP_DEVLIST and OP_REP_IMPORT.
+    """
+    busid = f'{busnum}-{devnum}'
+    return _DEVICE_RECORD.pack(
+        # fake a path, as we are dealing with virtual devices.
+        bytes(fake_path(busid), 'ascii'),
+        bytes(busid, 'ascii'),
+        busnum,
+        devnum,
+        device.speed(),
+        device.idVendor(),
+        device.idProduct(),
+        device.bcdDevice(),
+        device.bDeviceClass(),
+        device.bDeviceSubClass(),
+        device.bDeviceProtocol(),
+        device.bConfigurationValue(),
+        device.bNumConfigurations(),
+        device.bNumInterfaces()
+    )
+
+
+def pack_interface_records(device):
+    """
+    The interface records following a device record in OP_REP_DEVLIST.
+    """
+    return b''.join(
+        _INTERFACE_RECORD.pack(
+            interface.bInterfaceClass(),
+            interface.bInterfaceSubClass(),
+            interface.bInterfaceProtocol()
+        )
+        for interface in device.interfaces()
+    )
+
+
 class USBIPReplyDevlist:
     """
     Reply to a devlist request with a given devlist.
+
+    The device records come pre-packed from the devlist.
     """
 
     def __init__(self, devlist):
         self.devlist = devlist
 
-    def pack(self):
-        message = b''
-        message += struct.pack('>H', USBIP_VERSION)
-        message += struct.pack('>H', USBIPCommands.OP_REP_DEVLIST.value)
-        message += struct.pack('>I', 0x00)
-        message += struct.pack('>I', len(self.devlist.devices()))
-
-        for (busnum, devnum) in self.devlist.devices():
-            busid = f'{busnum}-{devnum}'
-            device = self.devlist.lookup((busnum, devnum))
-            device_info = b''
-            # fake a path, as we are dealing with virtual devices.
-            device_info += struct.pack(
-                    '256s',
-                    bytes(fake_path(busid), 'ascii')
-            )
-            device_info += struct.pack('32s', bytes(busid, 'ascii'))
-            device_info += struct.pack('>I', busnum)
-            device_info += struct.pack('>I', devnum)
-            device_info += struct.pack('>I', device.speed())
-            device_info += struct.pack('>H', device.idVendor())
-            device_info += struct.pack('>H', device.idProduct())
-            device_info += struct.pack('>H', device.bcdDevice())
-            device_info += struct.pack('>B', device.bDeviceClass())
-            device_info += struct.pack('>B', device.bDeviceSubClass())
-            device_info += struct.pack('>B', device.bDeviceProtocol())
-            device_info += struct.pack('>B', device.bConfigurationValue())
-            device_info += struct.pack('>B', device.bNumConfigurations())
-            device_info += struct.pack('>B', device.bNumInterfaces())
-            # get the interface information
-            for interface in device.interfaces():
-                interface_info = b''
-                interface_info += struct.pack(
-                        '>B', interface.bInterfaceClass()
-                )
-                interface_info += struct.pack(
-                        '>B', interface.bInterfaceSubClass()
-                )
-                interface_info += struct.pack(
-                        '>B', interface.bInterfaceProtocol()
-                )
-                interface_info += b'\x00'
-                device_info += interface_info
-            message += device_info
+    def segments(self):
+        """
+        The reply as a short header and the cached records, so the records
+        don't need copying.
+        """
+        count, records = self.devlist.devlist_records()
+        header = _OP_HEADER.pack(
+            USBIP_VERSION, USBIPCommands.OP_REP_DEVLIST.value, 0x00
+        ) + _DEVLIST_COUNT.pack(count)
+        return [header, records]
 
-        return message
+    def pack(self):
+        return b''.join(self.segments())
 
 
 class USBIPReplyImport:
     """
     Reply to a import message
+
+    `record` is the device's pre-packed record, if there is one.
     """
 
-    def __init__(self, busid, device):
+    def __init__(self, busid, device, record=None):
         self.device = device
         self.busid = busid
         self.busnum, self.devnum = tuple(map(int, busid.split('-')))
+        self.record = record
 
     def pack(self):
-        message = b''
-        message += struct.pack('>H', USBIP_VERSION)
-        message += struct.pack('>H', USBIPCommands.OP_REP_IMPORT.value)
-        message += struct.pack('>I', 0 if self.device else 1)
+        header = _OP_HEADER.pack(
+            USBIP_VERSION,
+            USBIPCommands.OP_REP_IMPORT.value,
+            0 if self.device else 1
+        )
 
         # check if we have a device or not.
         if not self.device:
-            return message
+            return header
 
-        device_info = b''
-        # fake a path, as we are dealing with virtual devices.
-        device_info += struct.pack(
-                '256s',
-                bytes(fake_path(self.busid), 'ascii')
-        )
-        device_info += struct.pack('32s', bytes(self.busid, 'ascii'))
-        device_info += struct.pack('>I', self.busnum)
-        device_info += struct.pack('>I', self.devnum)
-        device_info += struct.pack('>I', self.device.speed())
-        device_info += struct.pack('>H', self.device.idVendor())
-        device_info += struct.pack('>H', self.device.idProduct())
-        device_info += struct.pack('>H', self.device.bcdDevice())
-        device_info += struct.pack('>B', self.device.bDeviceClass())
-        device_info += struct.pack('>B', self.device.bDeviceSubClass())
-        device_info += struct.pack('>B', self.device.bDeviceProtocol())
-        device_info += struct.pack('>B', self.device.bConfigurationValue())
-        device_info += struct.pack('>B', self.device.bNumConfigurations())
-        device_info += struct.pack('>B', self.device.bNumInterfaces())
-
-        message += device_info
-        return message
+        record = self.record
+        if record is None:
+            record = pack_device_record(self.busnum, self.devnum, self.device)
+
+        return header + record
+
+
+def op_reply_length(buffer, offset=0):
+    """
+    Length of the OP_REP_* message starting at offset, or None if it hasn't
+    fully arrived yet.
+
+    OP_REP_DEVLIST has to be walked, as each device record is followed by a
+    variable number of interface records.
+    """
+    available = len(buffer) - offset
+    if available < OP_HEADER_LENGTH:
+        return None
+
+    _, cc, status = _OP_HEADER.unpack_from(buffer, offset)
+    match cc:
+        case USBIPCommands.OP_REP_IMPORT.value:
+            if status != 0:
+                return OP_HEADER_LENGTH
+            return OP_HEADER_LENGTH + DEVICE_RECORD_LENGTH
+        case USBIPCommands.OP_REP_DEVLIST.value:
+            length = OP_HEADER_LENGTH + _DEVLIST_COUNT.size
+            if available < length:
+                return None
+            count, = _DEVLIST_COUNT.unpack_from(buffer, offset + 8)
+            for _ in range(count):
+                if available < length + DEVICE_RECORD_LENGTH:
+                    return None
+                # bNumInterfaces is the last byte of the record.
+                interfaces = buffer[offset + length + DEVICE_RECORD_LENGTH - 1]
+                length += DEVICE_RECORD_LENGTH + \
+                    interfaces * INTERFACE_RECORD_LENGTH
+            return length if available >= length else None
+        case _:
+            raise ParseError(f'Unknown reply {cc:#x}, lost framing')
+
+
+def unpack_device_record(buffer, offset=0):
+    """
+    Parse a device record, without its interfaces.
+    """
+    try:
+        fields = list(_DEVICE_RECORD.unpack_from(buffer, offset))
+    except struct.error:
+        raise ParseError('Unable to unpack the device record')
+    fields[0] = fields[0].rstrip(b'\x00').decode('ascii')
+    fields[1] = fields[1].rstrip(b'\x00').decode('ascii')
+    return USBIPDeviceRecord(*fields, interfaces=())
+
+
+class USBIPServerMessage:
+    """
+    Server Message Format for the OP_REP_* messages, as read by a client.
+
+    `devices` holds the records from OP_REP_DEVLIST, or the imported device
+    from a successful OP_REP_IMPORT.
+    """
+
+    def __init__(self, data):
+        try:
+            version, cc, status = _OP_HEADER.unpack_from(data)
+        except struct.error:
+            raise ParseError('Unable to unpack the OP_REP message')
+
+        self.version = version
+        self.cc = USBIPCommands(cc)
+        self.status = status
+        self.devices = []
+
+        if self.version != USBIP_VERSION:
+            raise VersionError(f'Version {self.version} != {USBIP_VERSION}')
+
+        match self.cc:
+            case USBIPCommands.OP_REP_DEVLIST:
+                self._unpack_devlist(data)
+            case USBIPCommands.OP_REP_IMPORT if status == 0:
+                self.devices.append(
+                    unpack_device_record(data, OP_HEADER_LENGTH)
+                )
+
+    def _unpack_devlist(self, data):
+        try:
+            count, = _DEVLIST_COUNT.unpack_from(data, OP_HEADER_LENGTH)
+        except struct.error:
+            raise ParseError('Unable to unpack the device count')
+
+        offset = OP_HEADER_LENGTH + _DEVLIST_COUNT.size
+        for _ in range(count):
+            record = unpack_device_record(data, offset)
+            offset += DEVICE_RECORD_LENGTH
+            try:
+                interfaces = tuple(
+                    _INTERFACE_RECORD.unpack_from(
+                        data, offset + idx * INTERFACE_RECORD_LENGTH
+                    )
+                    for idx in range(record.bNumInterfaces)
+                )
+            except struct.error:
+                raise ParseError('Unable to unpack the interface records')
+            offset += len(interfaces) * INTERFACE_RECORD_LENGTH
+            self.devices.append(record._replace(interfaces=interfaces))
@@ -0,0 +1,128 @@
+"""
+Pre-fork mode, running several copies of a server on the same port.
+
+Devices (and any capture analysis behind them) are loaded once in the parent,
+then shared copy-on-write with the workers it forks. Each worker listens with
+SO_REUSEPORT, so the kernel spreads incoming connections across them.
+
+Every worker has its own copy of the device list, so imports are kept
+exclusive between them with lock files (see `DeviceList.share_claims()`).
+"""
+import gc
+import logging
+import os
+import shutil
+import signal
+import sys
+import tempfile
+import time
+
+
+class PreforkServer:
+    """
+    Runs `workers` forked copies of `server`, restarting any that die.
+
+    `server` is a `USBIPServer` or `AsyncioUSBIPServer`, which must not have
+    been started in this process.
+    """
+
+    # Don't restart a worker more often than this, in seconds, so a worker
+    # that dies on startup doesn't spin.
+    RESTART_DELAY = 1
+
+    def __init__(self, server, workers):
+        self.server = server
+        self.workers = workers
+        self._children = {}
+        self._stopping = False
+        self._claims_dir = None
+
+    def start(self):
+        if 'twisted.internet.reactor' in sys.modules:
+            # The workers would all share its epoll instance.
+            raise RuntimeError('Twisted reactor was created before forking')
+
+        self.prepare()
+        logging.info(f'Starting {self.workers} workers')
+
+        # Move everything loaded so far out of the collector's way, so it
+        # doesn't touch (and so copy) the shared pages in each worker.
+        gc.collect()
+        gc.freeze()
+
+        for idx in range(self.workers):
+            self._spawn(idx)
+
+        signal.signal(signal.SIGTERM, self._stop)
+        signal.signal(signal.SIGINT, self._stop)
+
+        try:
+            self._supervise()
+        finally:
+            if self._claims_dir is not None:
+                shutil.rmtree(self._claims_dir, ignore_errors=True)
+
+    def prepare(self):
+        """
+        Set up anything the workers share, before forking them.
+        """
+        if any(a.kind != 'tcp' for a in self.server.addresses):
+            # Only TCP ports can be shared with SO_REUSEPORT.
+            raise ValueError('Pre-fork mode only supports TCP addresses')
+
+        self.server.reuse_port = True
+        self._claims_dir = tempfile.mkdtemp(prefix='usbip-claims-')
+        self.server.devlist.share_claims(self._claims_dir)
+
+    def run(self, idx):
+        """
+        What worker `idx` does, in its own process.
+        """
+        logging.info(f'Worker {idx} running as {os.getpid()}')
+        self.server.start()
+
+    def _spawn(self, idx):
+        pid = os.fork()
+        if pid == 0:
+            self._run_worker(idx)
+
+        self._children[pid] = (idx, time.monotonic())
+
+    def _run_worker(self, idx):
+        signal.signal(signal.SIGTERM, signal.SIG_DFL)
+        signal.signal(signal.SIGINT, signal.SIG_DFL)
+        status = 0
+        try:
+            self.run(idx)
+        except BaseException:
+            logging.exception(f'Worker {idx} failed')
+            status = 1
+        finally:
+            os._exit(status)
+
+    def _supervise(self):
+        while self._children:
+            try:
+                pid, status = os.wait()
+            except ChildProcessError:
+                break
+            except InterruptedError:
+                continue
+
+            idx, started = self._children.pop(pid, (None, None))
+            if idx is None or self._stopping:
+                continue
+
+            logging.warning(f'Worker {idx} exited with {status}, restarting')
+            delay = self.RESTART_DELAY - (time.monotonic() - started)
+            if delay > 0:
+                time.sleep(delay)
+            self._spawn(idx)
+
+    def _stop(self, signum, frame):
+        self._stopping = True
+        for pid in self._children:
+            try:
+                os.kill(pid, signal.SIGTERM)
+            except ProcessLookupError:
+                pass
@@ -0,0 +1,288 @@
+"""
+Proxy between a USBIP client and an upstream server.
+
+Bytes are forwarded as they are read, without being reassembled into
+messages first, so the proxy adds little more than a socket hop. With a
+capture file, a tap follows both directions of the stream alongside and
+records each URB's submission and completion as usbmon packets, which can be
+loaded with `PCAPAnalysis` like a capture from real hardware.
+
+The stream can't be spliced between the sockets in the kernel, as the tap
+needs to see the bytes.
+"""
+import asyncio
+import logging
+import struct
+
+from protocol.capture import \
+        EINPROGRESS, \
+        NO_DATA_IN, \
+        NO_DATA_OUT, \
+        USBmonTransfer
+from .aio import AsyncioUSBIPServer
+from .client import open_connection
+from .exceptions import ParseError, VersionError
+from .framer import USBIPFramer
+from .message import \
+        op_reply_length, \
+        op_request_length, \
+        USBIPClientMessage, \
+        USBIPCommands, \
+        USBIPServerMessage
+from .usbip import \
+        process_message, \
+        ret_length, \
+        urb_length, \
+        USBIPCmdSubmit, \
+        USBIPCmdUnlink, \
+        USBIPDirection, \
+        USBIPReply
+
+_DESCRIPTOR_CONFIGURATION = 0x02
+_DESCRIPTOR_ENDPOINT = 0x05
+
+
+class USBIPTap:
+    """
+    Follows one connection's stream in both directions, writing the URBs on
+    it to `capture`, a `USBmonWriter`.
+
+    URB ids are the seqnum, with `conn_no` in the top half so connections
+    sharing a capture don't collide.
+    """
+
+    def __init__(self, capture, conn_no):
+        self.capture = capture
+        self.conn_no = conn_no
+        self.requests = USBIPFramer(op_request_length)
+        self.replies = USBIPFramer(op_reply_length)
+        self.busnum = 0
+        self.devnum = 0
+        # seqnum -> (direction, endpoint, transfer type, setup) of URBs
+        # waiting on their RET_SUBMIT.
+        self._pending = {}
+        # seqnum of a CMD_UNLINK -> the seqnum it unlinks.
+        self._unlinks = {}
+        # Transfer types of the endpoints, from configuration descriptors.
+        self._transfers = {}
+
+    def _urb_id(self, seqnum):
+        return self.conn_no << 32 | seqnum
+
+    def _direction_of(self, seqnum):
+        pending = self._pending.get(seqnum)
+        return pending[0] if pending else None
+
+    def _reply_length(self, buffer, offset=0):
+        return ret_length(buffer, offset, self._direction_of)
+
+    def from_client(self, data):
+        for message in self.requests.feed(data):
+            if self.requests.length_function is urb_length:
+                self._command(process_message(message))
+                continue
+
+            request = USBIPClientMessage(message)
+            if request.cc == USBIPCommands.OP_REQ_IMPORT:
+                self.requests.length_function = urb_length
+
+    def from_server(self, data):
+        for message in self.replies.feed(data):
+            if self.replies.length_function is op_reply_length:
+                reply = USBIPServerMessage(message)
+                if reply.cc == USBIPCommands.OP_REP_IMPORT and \
+                        reply.status == 0:
+                    record, = reply.devices
+                    self.busnum, self.devnum = record.busnum, record.devnum
+                    self.replies.length_function = self._reply_length
+                continue
+
+            self._reply(USBIPReply(message))
+
+    def _command(self, command):
+        if isinstance(command, USBIPCmdSubmit):
+            direction = USBIPDirection(command.direction)
+            endpoint = command.ep
+            if direction == USBIPDirection.USBIP_DIR_IN:
+                endpoint |= 0x80
+
+            setup = None
+            if command.ep == 0:
+                transfer = USBmonTransfer.CONTROL
+                setup = bytes(command.setup)
+            else:
+                transfer = self._transfers.get(endpoint, USBmonTransfer.BULK)
+
+            self._pending[command.seqnum] = \
+                (direction, endpoint, transfer, setup)
+            self.capture.record(
+                self._urb_id(command.seqnum), 'S', transfer, endpoint,
+                self.devnum, self.busnum, EINPROGRESS,
+                command.transfer_buffer_length, setup,
+                command.transfer_buffer, NO_DATA_IN
+            )
+        elif isinstance(command, USBIPCmdUnlink):
+            self._unlinks[command.seqnum] = command.unlink_seqnum
+
+    def _reply(self, reply):
+        seqnum = reply.seqnum
+        if seqnum in self._unlinks:
+            # A successful unlink means the URB never gets a RET_SUBMIT, so
+            # complete it here with the unlink's status.
+            seqnum = self._unlinks.pop(seqnum)
+            if reply.status == 0 or seqnum not in self._pending:
+                return
+
+        pending = self._pending.pop(seqnum, None)
+        if pending is None:
+            return
+
+        direction, endpoint, transfer, setup = pending
+        data = b''
+        if direction == USBIPDirection.USBIP_DIR_IN:
+            data = reply.data[:reply.actual_length]
+            if setup is not None:
+                self._learn_endpoints(setup, data)
+
+        self.capture.record(
+            self._urb_id(seqnum), 'C', transfer, endpoint, self.devnum,
+            self.busnum, reply.status, reply.actual_length, None, data,
+            NO_DATA_OUT
+        )
+
+    def _learn_endpoints(self, setup, data):
+        """
+        Pick up the transfer type of each endpoint from the configuration
+        descriptors the host reads, as usbmon knows them from the URBs.
+        """
+        if setup[:2] != b'\x80\x06' or setup[3] != _DESCRIPTOR_CONFIGURATION:
+            return
+
+        offset = 0
+        while offset + 2 <= len(data):
+            length, kind = struct.unpack_from('BB', data, offset)
+            if length < 2:
+                break
+            if kind == _DESCRIPTOR_ENDPOINT and offset + 4 <= len(data):
+                address, attributes = struct.unpack_from(
+                    'BB', data, offset + 2
+                )
+                self._transfers[address] = \
+                    USBmonTransfer.from_attributes(attributes)
+            offset += length
+
+
+class ProxyProtocol(asyncio.Protocol):
+    """
+    One side of a proxied connection, writing what it reads to its `peer`.
+
+    Each side stops reading while the other has too much waiting to be
+    written, so a slow reader holds back the fast writer rather than the
+    proxy buffering everything in between.
+    """
+
+    def __init__(self, tap=None):
+        self.transport = None
+        self.peer = None
+        self.tap = tap
+
+    def connection_made(self, transport):
+        self.transport = transport
+
+    def data_received(self, data):
+        self.peer.transport.write(data)
+        if self.tap is None:
+            return
+        try:
+            self.tap(data)
+        except (ParseError, VersionError, ValueError) as e:
+            # Keep forwarding, the capture is just missing the rest.
+            logging.error(f'Stopped capturing connection: {e}')
+            self.tap = None
+
+    def pause_writing(self):
+        self.peer.transport.pause_reading()
+
+    def resume_writing(self):
+        self.peer.transport.resume_reading()
+
+    def eof_received(self):
+        return False
+
+    def connection_lost(self, exc):
+        if self.peer is not None and self.peer.transport is not None:
+            self.peer.transport.close()
+
+
+class ProxyClientProtocol(ProxyProtocol):
+    """
+    The client's side, which connects to the upstream server for it.
+    """
+
+    def __init__(self, proxy, tap=None):
+        super().__init__(tap and tap.from_client)
+        self.proxy = proxy
+        self.upstream_tap = tap and tap.from_server
+        self._connecting = None
+
+    def connection_made(self, transport):
+        super().connection_made(transport)
+        # Nothing can be forwarded until the upstream connection is up.
+        transport.pause_reading()
+        self._connecting = asyncio.ensure_future(self._connect())
+
+    async def _connect(self):
+        upstream = ProxyProtocol(self.upstream_tap)
+        upstream.peer = self
+        try:
+            await open_connection(
+                self.proxy.upstream, lambda: upstream
+            )
+        except OSError as e:
+            logging.error(f'Unable to connect upstream: {e}')
+            self.transport.close()
+            return
+        self.peer = upstream
+        if not self.transport.is_closing():
+            self.transport.resume_reading()
+        else:
+            upstream.transport.close()
+
+    def connection_lost(self, exc):
+        super().connection_lost(exc)
+        self.proxy.connection_closed()
+
+
+class USBIPProxy(AsyncioUSBIPServer):
+    """
+    Listens on `listen` like a server, proxying every connection to
+    `upstream`, a `ListenAddress`.
+
+    With `capture`, a `USBmonWriter`, the URBs on every connection are
+    written to it.
+    """
+
+    def __init__(self, upstream, listen, capture=None):
+        super().__init__(None, None, None, listen=listen)
+        self.upstream = upstream
+        self.capture = capture
+        self._conn_no = 0
+
+    def protocol(self):
+        tap = None
+        if self.capture is not None:
+            self._conn_no += 1
+            tap = USBIPTap(self.capture, self._conn_no)
+        return ProxyClientProtocol(self, tap)
+
+    def connection_closed(self):
+        if self.capture is not None:
+            self.capture.flush()
+
+    def start(self):
+        logging.info(f'Proxying to {self.upstream}')
+        try:
+            super().start()
+        finally:
+            if self.capture is not None:
+                self.capture.close()
@@ -0,0 +1,233 @@
+"""
+Router mode, giving each device a worker process of its own.
+
+A front process accepts every connection and handles the OP phase itself:
+devlist requests are answered from the device list, and on OP_REQ_IMPORT the
+connection's socket is passed over SCM_RIGHTS to the worker owning that busid.
+From then on URBs flow straight between the host and the worker, so a heavy
+device has a core to itself, and can crash or be restarted without taking the
+others with it.
+
+Each worker is sent connections over a SOCK_SEQPACKET socketpair opened by
+the supervising process, which keeps both ends. A connection handed over
+while its worker is being restarted waits in the socket for the new one, or
+has its import refused if the socket is full.
+"""
+import asyncio
+import logging
+import os
+import socket
+
+from .aio import AsyncioUSBIPServer
+from .exceptions import ParseError, VersionError
+from .framer import USBIPFramer
+from .listen import tcp_address
+from .message import \
+        op_request_length, \
+        USBIPClientMessage, \
+        USBIPCommands, \
+        USBIPReplyDevlist, \
+        USBIPReplyImport
+from .prefork import PreforkServer
+
+# Most a handoff can carry, the import request and anything sent after it.
+HANDOFF_SIZE = 0x10000
+
+
+class RouterProtocol(asyncio.Protocol):
+    """
+    Front side of a connection, until it is handed to a worker.
+    """
+
+    def __init__(self, devlist, channels):
+        self.devlist = devlist
+        self.channels = channels
+        self.framer = USBIPFramer(op_request_length)
+        self.transport = None
+
+    def connection_made(self, transport):
+        self.transport = transport
+
+    def data_received(self, data):
+        messages = self.framer.feed(data)
+        try:
+            for message in messages:
+                request = USBIPClientMessage(message)
+                match request.cc:
+                    case USBIPCommands.OP_REQ_DEVLIST:
+                        logging.info('requesting devlist')
+                        reply = USBIPReplyDevlist(self.devlist)
+                        self.transport.writelines(reply.segments())
+                        self.transport.close()
+                        return
+                    case USBIPCommands.OP_REQ_IMPORT:
+                        # Whatever follows belongs to the worker.
+                        messages.close()
+                        self.hand_off(
+                            request.busid,
+                            bytes(message) + self.framer.detach()
+                        )
+                        return
+                    case _:
+                        logging.error('unknown command?')
+        except (ParseError, VersionError) as e:
+            logging.error(str(e))
+            self.transport.close()
+
+    def hand_off(self, busid, data):
+        """
+        Pass the connection to the worker for `busid`, along with the data
+        read from it so far, so the worker can answer the import.
+        """
+        channel = self.channels.get(busid)
+        if channel is None or len(data) > HANDOFF_SIZE:
+            logging.warning(f'No worker for {busid}')
+            self.refuse(busid)
+            return
+
+        logging.info(f'Handing {busid} to its worker')
+        self.transport.pause_reading()
+        sock = self.transport.get_extra_info('socket')
+        try:
+            socket.send_fds(channel, [data], [sock.fileno()])
+        except OSError as e:
+            # The channel is non-blocking, so a worker that is stuck or
+            # gone fails the import instead of stalling every connection.
+            logging.warning(f'Unable to hand {busid} to its worker: {e}')
+            self.refuse(busid)
+            return
+        # The worker has its own copy of the socket now, so closing ours
+        # leaves the connection up.
+        self.transport.abort()
+
+    def refuse(self, busid):
+        """
+        Fail the import, and close the connection.
+        """
+        self.transport.write(USBIPReplyImport(busid, None).pack())
+        self.transport.close()
+
+    def eof_received(self):
+        return False
+
+
+class RouterFront(AsyncioUSBIPServer):
+    """
+    The listening side of router mode, doing the OP phase for every
+    connection.
+    """
+
+    def __init__(self, device_list, channels, listen):
+        super().__init__(None, None, device_list, listen=listen)
+        self.channels = channels
+
+    def protocol(self):
+        return RouterProtocol(self.devlist, self.channels)
+
+
+class RouterWorker(AsyncioUSBIPServer):
+    """
+    Serves connections handed over from the front on `channel`, rather than
+    listening itself.
+    """
+
+    def __init__(self, device_list, channel, **options):
+        super().__init__(None, None, device_list, **options)
+        self.channel = channel
+
+    async def serve(self):
+        loop = asyncio.get_running_loop()
+        self.channel.setblocking(False)
+        loop.add_reader(self.channel.fileno(), self._receive, loop)
+        try:
+            await loop.create_future()
+        finally:
+            loop.remove_reader(self.channel.fileno())
+
+    def _receive(self, loop):
+        while True:
+            try:
+                data, fds, _, _ = socket.recv_fds(
+                    self.channel, HANDOFF_SIZE, 1
+                )
+            except BlockingIOError:
+                return
+            except OSError as e:
+                logging.error(f'Unable to receive connections: {e}')
+                loop.remove_reader(self.channel.fileno())
+                return
+
+            if not data and not fds:
+                # The front's end is closed, so nothing more is coming.
+                logging.warning('Channel from the front closed')
+                loop.remove_reader(self.channel.fileno())
+                return
+
+            for fd in fds:
+                loop.create_task(self.adopt(socket.socket(fileno=fd), data))
+
+    async def adopt(self, sock, data):
+        """
+        Take over a connection from the front, replaying what it read.
+        """
+        loop = asyncio.get_running_loop()
+        _, protocol = await loop.connect_accepted_socket(
+            self.protocol, sock
+        )
+        buffer = protocol.get_buffer(len(data))
+        buffer[:len(data)] = data
+        protocol.buffer_updated(len(data))
+
+
+class RouterServer(PreforkServer):
+    """
+    Runs the front and a worker per device, each in their own process,
+    restarting any that die.
+
+    Takes the same arguments as `AsyncioUSBIPServer`, passing the session
+    options on to the workers.
+    """
+
+    def __init__(self, host, port, device_list, listen=None, **options):
+        front = RouterFront(
+            device_list, {}, listen or [tcp_address(host, port)]
+        )
+        self.devlist = device_list
+        self.options = options
+        self.busids = [
+            '{}-{}'.format(*busid) for busid in device_list.devices()
+        ]
+        super().__init__(front, 1 + len(self.busids))
+        # busid -> (front end, worker end) of its channel.
+        self._channels = {}
+
+    def start(self):
+        try:
+            super().start()
+        finally:
+            for sockets in self._channels.values():
+                for sock in sockets:
+                    sock.close()
+
+    def prepare(self):
+        for busid in self.busids:
+            front, worker = socket.socketpair(
+                socket.AF_UNIX, socket.SOCK_SEQPACKET
+            )
+            # Handoffs run on the front's loop, so must never block it.
+            front.setblocking(False)
+            self._channels[busid] = (front, worker)
+        self.server.channels.update(
+            (busid, front) for busid, (front, _) in self._channels.items()
+        )
+
+    def run(self, idx):
+        if idx == 0:
+            logging.info(f'Router running as {os.getpid()}')
+            self.server.start()
+            return
+
+        busid = self.busids[idx - 1]
+        logging.info(f'Worker for {busid} running as {os.getpid()}')
+        _, channel = self._channels[busid]
+        RouterWorker(self.devlist, channel, **self.options).start()
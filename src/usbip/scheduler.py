@@ -0,0 +1,130 @@
+"""
+Fair scheduling of URBs across connections.
+
+Without a scheduler each connection starts URBs as soon as they are read, so
+a host flooding CMD_SUBMITs keeps the loop busy with its own URBs while every
+other host's control transfers wait behind them.
+"""
+import math
+from collections import deque
+
+# Shortest wait for a throttled session, as a wait rounded down to nothing
+# would have it woken at the same instant, with the same tokens, forever.
+MIN_WAIT = 0.001
+
+
+class URBScheduler:
+    """
+    Shares the server between connections with weighted round robin.
+
+    Sessions given a scheduler queue their URBs in their `backlog` and mark
+    themselves ready. Each pass the scheduler visits the ready sessions in
+    turn, starting up to `quantum` URBs from each, times the weight for the
+    busid it imported in `weights`, and yields back to the loop after
+    `budget` URBs so reads and writes for other connections aren't held up.
+
+    Turns are counted in URBs, not bytes, and no credit is carried between
+    passes, so a connection sending large transfers gets more bandwidth
+    than one sending small ones.
+
+    With `rate`, each connection is also limited to that many URBs a second,
+    in bursts of up to `burst`.
+    """
+
+    def __init__(self, quantum=4, budget=64, rate=None, burst=None,
+                 weights=None):
+        self.quantum = quantum
+        self.budget = budget
+        self.rate = rate
+        self.burst = burst or max(rate or 0, 1)
+        self.weights = weights or {}
+        self._ready = deque()
+        self._queued = set()
+        # session -> (tokens, when they were counted), for rate limiting.
+        self._tokens = {}
+        self._clock = None
+        self._call = None
+        self._call_at = None
+
+    def weight(self, session):
+        return self.weights.get(session.busid, 1)
+
+    def ready(self, session):
+        """
+        Called by a session with URBs it can start.
+        """
+        self._clock = session.clock
+        if session not in self._queued:
+            self._queued.add(session)
+            self._ready.append(session)
+        self._schedule(0)
+
+    def remove(self, session):
+        """
+        Forget a session that has disconnected.
+        """
+        self._tokens.pop(session, None)
+        if session in self._queued:
+            self._queued.discard(session)
+            self._ready.remove(session)
+
+    def _schedule(self, delay):
+        when = self._clock.seconds() + delay
+        if self._call is not None:
+            if self._call_at <= when:
+                return
+            # Something became ready before a throttled session's wakeup.
+            self._call.cancel()
+        self._call = self._clock.callLater(delay, self._run)
+        self._call_at = when
+
+    def _take_tokens(self, session, now):
+        tokens, counted = self._tokens.get(session, (self.burst, now))
+        return min(self.burst, tokens + (now - counted) * self.rate)
+
+    def _run(self):
+        self._call = None
+        now = self._clock.seconds()
+        budget = self.budget
+        # How long until a throttled session can go again.
+        wait = math.inf
+        progress = True
+
+        while self._ready and budget > 0 and progress:
+            progress = False
+            for _ in range(len(self._ready)):
+                session = self._ready.popleft()
+                allowance = min(self.quantum * self.weight(session), budget)
+
+                if self.rate:
+                    tokens = self._take_tokens(session, now)
+                    if tokens < 1:
+                        self._tokens[session] = (tokens, now)
+                        wait = min(
+                            wait, max((1 - tokens) / self.rate, MIN_WAIT)
+                        )
+                        self._ready.append(session)
+                        continue
+                    allowance = min(allowance, int(tokens))
+
+                started = session.service(allowance)
+                if self.rate:
+                    self._tokens[session] = (tokens - started, now)
+
+                budget -= started
+                progress = progress or started > 0
+
+                if session.runnable():
+                    self._ready.append(session)
+                else:
+                    self._queued.discard(session)
+
+                if budget <= 0:
+                    break
+
+        if not self._ready:
+            return
+        if budget <= 0 or progress:
+            self._schedule(0)
+        elif wait < math.inf:
+            self._schedule(wait)
@@ -6,133 +6,190 @@ Based on:
 """
 # import binascii
 import logging
-from enum import Enum
+import socket
 from twisted.internet.protocol import Protocol, Factory
-from twisted.internet.endpoints import TCP4ServerEndpoint
-from twisted.internet import reactor
+from twisted.internet.endpoints import \
+        TCP4ServerEndpoint, \
+        UNIXServerEndpoint
+from twisted.internet.interfaces import IPushProducer
+from twisted.internet import defer
+from zope.interface import implementer
 
-from .message import \
-        USBIPClientMessage, \
-        USBIPCommands, \
-        USBIPReplyDevlist, \
-        USBIPReplyImport
-
-from protocol.usb import USBPacket
-from .usbip import process_message, USBIPCmd, USBIPRetUnlink, USBIPRetSubmit
-
-
-USBIPState = Enum('USBIPState', ['OP', 'USBIP'])
+from .connections import Connections
+from .listen import tcp_address, remove_stale_socket
+from .session import USBIPSession
+from .sockopt import set_keepalive
 
 
+@implementer(IPushProducer)
 class USBIP(Protocol):
     """
-    Server side of the USBIP implementation.
+    Twisted side of a USBIP connection, see `USBIPSession` for the protocol
+    itself and the options it takes.
+
+    Registers itself as a producer with the transport, which pauses it when
+    the write buffer fills.
     """
 
-    def __init__(self, devlist):
-        self.devlist = devlist
-        self.state = USBIPState.OP
-        self.device = None
+    def __init__(self, devlist, clock=None, **options):
+        if clock is None:
+            from twisted.internet import reactor as clock
+        self.session = USBIPSession(devlist, self, clock, **options)
         super().__init__()
 
     def connectionMade(self):
-        pass
+        self.transport.registerProducer(self, True)
+        self.session.connection_made()
 
     def connectionLost(self, reason):
-        pass
+        self.session.connection_lost()
 
     def dataReceived(self, data):
-        logging.debug('Message Recieved')
-        match self.state:
-            case USBIPState.OP:
-                self.operation(data)
-            case USBIPState.USBIP:
-                self.command(data)
-
-    def operation(self, data):
-        message = USBIPClientMessage(data)
-        match message.cc:
-            case USBIPCommands.OP_REQ_DEVLIST:
-                logging.info('requesting devlist')
-                # sending the devlist, then kill the connection.
-                reply = USBIPReplyDevlist(self.devlist)
-                self.transport.write(reply.pack())
-                self.transport.loseConnection()
-
-            case USBIPCommands.OP_REQ_IMPORT:
-                logging.info(f'importing {message.busid}')
-                busid = str(message.busid)
-
-                busid_ = tuple(map(int, busid.split('-')))
-
-                # if the device exists, we can transisition over to
-                # the usbip case and process those packets.
-                self.device = self.devlist.lookup(busid_)
-                # now send a message based on if this device lookup was
-                # succesful.
-                reply = USBIPReplyImport(busid, self.device)
-                self.transport.write(reply.pack())
-
-                if self.device:
-                    self.state = USBIPState.USBIP
-                else:
-                    self.transport.loseConnection()
-
-            case _:
-                logging.error('unknown command?')
-
-    def command(self, data):
-        if not self.device:
-            return
-        res = process_message(data)
-        if res:
-            match res.command:
-                case USBIPCmd.USBIP_CMD_SUBMIT:
-                    usb_packet = USBPacket(
-                        0, res.ep, res.setup, res.transfer_buffer
-                    )
-                    # All zero setup packets are just worth ignoring it seems.
-                    # avoids an annoying bug where the host will spam URBs.
-                    if usb_packet.setup.bytes == b'\x00'*8:
-                        return
-                    # now let the device process the message
-                    response = self.device.command(usb_packet)
-                    # decide how we pack this.
-                    if response:
-                        self.transport.write(
-                            USBIPRetSubmit(
-                                res.seqnum, 0, response.pack()
-                            ).pack()
-                        )
-                    else:
-                        self.transport.write(
-                            USBIPRetSubmit(res.seqnum, -32, b'').pack()
-                        )
-                case USBIPCmd.USBIP_CMD_UNLINK:
-                    return self.transport.write(
-                            USBIPRetUnlink(res.seqnum, 0).pack()
-                    )
+        self.session.data_received(data)
+
+    # IPushProducer, for the transport.
+
+    def pauseProducing(self):
+        self.session.pause_producing()
+
+    def resumeProducing(self):
+        self.session.resume_producing()
+
+    def stopProducing(self):
+        pass
+
+    # The link used by the session.
+
+    def send(self, segments):
+        self.transport.writeSequence(segments)
+
+    def close(self):
+        self._unregister()
+        self.transport.loseConnection()
+
+    def _tcp_socket(self):
+        # UNIX transports provide ITCPTransport too, so go by the family.
+        get_handle = getattr(self.transport, 'getHandle', None)
+        sock = get_handle() if get_handle else None
+        if getattr(sock, 'family', None) not in \
+                (socket.AF_INET, socket.AF_INET6):
+            return None
+        return sock
+
+    def set_nodelay(self, value):
+        sock = self._tcp_socket()
+        if sock is not None:
+            sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, int(value))
+
+    def set_cork(self, value):
+        sock = self._tcp_socket()
+        if sock is not None and hasattr(socket, 'TCP_CORK'):
+            sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_CORK, int(value))
+
+    def as_deferred(self, result):
+        return defer.ensureDeferred(result)
+
+    def set_keepalive(self, idle):
+        sock = self._tcp_socket()
+        if sock is not None:
+            set_keepalive(sock, idle)
+
+    def set_write_limits(self, high, low):
+        # Twisted has no low watermark, it resumes once the buffer is empty.
+        self.transport.bufferSize = high
+
+    def buffered(self):
+        # FileDescriptor doesn't expose this, so work it out from its
+        # buffers. Other transports are treated as unbuffered.
+        transport = self.transport
+        try:
+            return len(transport.dataBuffer) - transport.offset + \
+                transport._tempDataLen
+        except AttributeError:
+            return 0
+
+    def pause_reading(self):
+        self.transport.pauseProducing()
+
+    def resume_reading(self):
+        if not self.transport.disconnecting:
+            self.transport.resumeProducing()
+
+    def abort(self):
+        self._unregister()
+        self.transport.abortConnection()
+
+    def _unregister(self):
+        # While registered, a paused producer gets resumed when the buffer
+        # drains, rather than the connection being closed.
+        if self.transport.producer is not None:
+            self.transport.unregisterProducer()
 
 
 class USBIPFactory(Factory):
-    def __init__(self, devlist):
+    """
+    Builds a USBIP protocol per connection, passing `options` on to it.
+    """
+
+    def __init__(self, devlist, **options):
         self.devlist = devlist
+        self.options = options
         super().__init__()
 
     def buildProtocol(self, addr):
-        return USBIP(self.devlist)
+        return USBIP(self.devlist, **self.options)
 
 
 class USBIPServer:
     """
     Wrapper around the Twisted Server.
+
+    Listens on `host`:`port` over TCP, or on each of `listen` instead if
+    given, which is a list of `ListenAddress` (TCP or UNIX sockets).
+
+    With `reuse_port`, TCP sockets are opened with SO_REUSEPORT so several
+    processes can share the port.
+
+    Any extra keyword arguments are options for each `USBIPSession`. Open
+    connections are tracked in `connections`.
+
+    The reactor is only imported once the server starts, so a process can
+    set everything up and fork before any reactor exists (see `prefork`).
     """
 
-    def __init__(self, host, port, device_list):
-        self.endpoint = TCP4ServerEndpoint(reactor, port, interface=host)
+    def __init__(self, host, port, device_list, reuse_port=False,
+                 listen=None, **options):
+        self.addresses = listen or [tcp_address(host, port)]
         self.devlist = device_list
+        self.reuse_port = reuse_port
+        self.connections = Connections()
+        self.options = {'connections': self.connections, **options}
 
     def start(self):
+        from twisted.internet import reactor
+
         logging.info('Starting Server')
-        self.endpoint.listen(USBIPFactory(self.devlist))
+        factory = USBIPFactory(self.devlist, **self.options)
+        for address in self.addresses:
+            self.listen(reactor, address, factory)
         reactor.run()
+
+    def listen(self, reactor, address, factory):
+        if address.kind == 'unix':
+            remove_stale_socket(address.path)
+            UNIXServerEndpoint(reactor, address.path).listen(factory)
+        elif self.reuse_port:
+            sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+            sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+            sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEPORT, 1)
+            sock.bind((address.host, address.port))
+            sock.listen(socket.SOMAXCONN)
+            sock.setblocking(False)
+            reactor.adoptStreamPort(sock.fileno(), socket.AF_INET, factory)
+            # The reactor has its own copy of the descriptor now.
+            sock.close()
+        else:
+            endpoint = TCP4ServerEndpoint(
+                reactor, address.port, interface=address.host
+            )
+            endpoint.listen(factory)
@@ -0,0 +1,665 @@
+"""
+The USBIP protocol state machine, independent of the event loop driving it.
+
+Each engine (Twisted in `server.py`, asyncio in `aio.py`) wraps a connection
+in a "link", which the session uses to talk to the outside world:
+
+* `send(segments)` writes a list of buffers as one vectored write.
+* `close()` closes the connection once everything written has gone out.
+* `set_nodelay(value)` / `set_cork(value)` tune the socket, where possible.
+* `as_deferred(awaitable)` turns whatever a device returned into a Deferred,
+  running coroutines on the engine's loop.
+* `set_write_limits(high, low)` sets the write buffer watermarks, and
+  `buffered()` says how much is in it.
+* `pause_reading()` / `resume_reading()` stop and start reading from the
+  host.
+* `abort()` drops the connection without waiting for the buffer to drain.
+* `set_keepalive(idle)` turns on TCP keepalive, see `sockopt`.
+
+along with a clock providing Twisted's `callLater()`. Engines call the
+session's `pause_producing()` / `resume_producing()` as the write buffer goes
+over / back under the watermarks.
+"""
+import errno
+import inspect
+import logging
+from collections import deque
+from enum import Enum
+from twisted.internet import defer
+
+from .message import \
+        USBIPClientMessage, \
+        USBIPCommands, \
+        USBIPReplyDevlist, \
+        USBIPReplyImport, \
+        op_request_length
+
+from protocol.usb import USBPacket
+from .exceptions import ParseError, VersionError
+from .framer import USBIPFramer
+from .usbip import \
+        process_message, \
+        urb_length, \
+        USBIPCmd, \
+        USBIPDirection, \
+        USBIPReplyEncoder
+
+
+USBIPState = Enum('USBIPState', ['OP', 'USBIP'])
+
+# What to do when a connection goes over `write_limit`.
+OVERFLOW_POLICIES = ('disconnect', 'drop')
+
+
+class USBIPSession:
+    """
+    Server side of the USBIP implementation, for a single connection.
+
+    URB replies are gathered up and written once per loop iteration, so
+    URBs completing together go out in a single write.
+
+    `nodelay` sets TCP_NODELAY on the connection, so lone control transfers
+    aren't held back by Nagle. `cork` additionally sets TCP_CORK while a
+    batch of replies is being written, so it leaves in full segments.
+
+    Devices can return a Deferred or awaitable from `command()`. Those URBs
+    are kept in `inflight` by seqnum until they complete, in whatever order
+    that happens, and can be cancelled by the host with CMD_UNLINK. At most
+    `queue_depth` are in flight at once, the rest wait in `backlog`. If
+    `urb_timeout` is set, URBs taking longer than that many seconds fail
+    with ETIMEDOUT.
+
+    With a `scheduler` (see `URBScheduler`) shared between sessions, every
+    URB waits in `backlog` until the scheduler gives this connection its
+    turn. How long URBs spent waiting is reported by `resources()`. Once
+    `backlog_limit` URBs are waiting, the session stops reading from the
+    host until the backlog is down to half that.
+
+    IN URBs for the device's other endpoints are parked in `parked` until
+    the device pushes data for them (see `BaseDevice.push()`), rather than
+    being completed empty and resubmitted by the host in a loop.
+
+    When the host stops reading and the write buffer goes over `write_high`
+    bytes, the session stops reading URBs from it and pauses the device
+    until the buffer drains below `write_low`. (Twisted only resumes once its
+    buffer is empty.) If the write buffer plus the data the device has
+    queued for the host still goes over `write_limit`, `overflow` decides
+    what happens: 'disconnect' drops the connection, 'drop' throws away the
+    device's queued data as a full FIFO would, and only drops the connection
+    if the replies alone are over the limit. A message from the host longer
+    than `write_limit` closes the connection before any of it is buffered.
+
+    `keepalive` turns on TCP keepalive after that many seconds of silence,
+    so half-open connections from hosts that went away get noticed. With
+    `idle_timeout`, a connection that hasn't sent anything for that long,
+    and has no URBs outstanding, is closed.
+
+    Sessions add themselves to `connections` while they are connected, and
+    `resources()` says what each is holding. When the connection goes,
+    everything it held is released: the device's import, its queued data
+    (see `BaseDevice.detached()`), and every URB in flight or waiting.
+    """
+
+    def __init__(self, devlist, link, clock, nodelay=True, cork=False,
+                 queue_depth=32, urb_timeout=None, write_high=0x10000,
+                 write_low=0x4000, write_limit=0x1000000,
+                 overflow='disconnect', keepalive=60, idle_timeout=None,
+                 connections=None, scheduler=None, backlog_limit=256):
+        if overflow not in OVERFLOW_POLICIES:
+            raise ValueError(f'Unknown overflow policy {overflow}')
+
+        self.devlist = devlist
+        self.link = link
+        self.clock = clock
+        self.state = USBIPState.OP
+        self.device = None
+        self.busid = None
+        self.framer = USBIPFramer(op_request_length, write_limit)
+        self.encoder = USBIPReplyEncoder()
+        self.nodelay = nodelay
+        self.cork = cork
+        self._pending = []
+        # Size of the replies in _pending.
+        self._pending_bytes = 0
+        self._flush_call = None
+        self._uncork_call = None
+        self.queue_depth = queue_depth
+        self.urb_timeout = urb_timeout
+        self.inflight = {}
+        # (arrival time, URB) waiting to be started.
+        self.backlog = deque()
+        self.backlog_limit = backlog_limit
+        # Set while reading is paused for a full backlog.
+        self.backlog_full = False
+        self.scheduler = scheduler
+        # IN URBs on other endpoints, waiting for the device to push data.
+        self.parked = {}
+        self.write_high = write_high
+        self.write_low = write_low
+        self.write_limit = write_limit
+        self.overflow = overflow
+        self.paused = False
+        # Set once the overflow policy drops the connection.
+        self.aborted = False
+        self.keepalive = keepalive
+        self.idle_timeout = idle_timeout
+        self._idle_call = None
+        self.connections = connections
+        # Accounting for resources().
+        self.connected_at = None
+        self.last_activity = None
+        self.bytes_received = 0
+        self.bytes_sent = 0
+        self.urbs = 0
+        self.queue_delay_total = 0
+        self.queue_delay_max = 0
+
+    def connection_made(self):
+        self.connected_at = self.last_activity = self.clock.seconds()
+        self.link.set_nodelay(self.nodelay)
+        self.link.set_keepalive(self.keepalive)
+        self.link.set_write_limits(self.write_high, self.write_low)
+        if self.idle_timeout:
+            self._idle_call = self.clock.callLater(
+                self.idle_timeout, self._check_idle
+            )
+        if self.connections is not None:
+            self.connections.add(self)
+
+    def connection_lost(self):
+        """
+        Release everything held for the connection.
+        """
+        self.devlist.release_all(self)
+
+        for call in (self._flush_call, self._uncork_call, self._idle_call):
+            if call and call.active():
+                call.cancel()
+        self._flush_call = None
+        self._uncork_call = None
+        self._idle_call = None
+        self._pending = []
+        self._pending_bytes = 0
+        self.framer.clear()
+
+        self.backlog.clear()
+        self.backlog_full = False
+        self.parked.clear()
+        if self.scheduler is not None:
+            self.scheduler.remove(self)
+        inflight, self.inflight = self.inflight, {}
+        for d in inflight.values():
+            d.cancel()
+
+        if self.device:
+            self.device.unsubscribe(self.data_available)
+            self.device.detached()
+        self.paused = False
+
+        if self.connections is not None:
+            self.connections.remove(self)
+        self.device = None
+
+    def resources(self):
+        """
+        What this connection is holding, and has done so far.
+        """
+        return {
+            'age': self.clock.seconds() - (self.connected_at or 0),
+            'bytes_received': self.bytes_received,
+            'bytes_sent': self.bytes_sent,
+            'urbs': self.urbs,
+            'inflight': len(self.inflight),
+            'backlog': len(self.backlog),
+            'parked': sum(map(len, self.parked.values())),
+            'read_buffer': self.framer.pending(),
+            'write_buffer': self.held(),
+            'device_queued': self.device.queued() if self.device else 0,
+            'queue_delay_total': self.queue_delay_total,
+            'queue_delay_max': self.queue_delay_max
+        }
+
+    def _check_idle(self):
+        """
+        Close the connection if the host has gone quiet with nothing
+        outstanding, otherwise check again when it next could be.
+        """
+        self._idle_call = None
+        busy = self.inflight or self.backlog or any(self.parked.values())
+        idle = self.clock.seconds() - self.last_activity
+        if not busy and idle >= self.idle_timeout:
+            logging.info(f'Closing connection, idle for {idle:.0f}s')
+            self.link.close()
+            return
+
+        delay = self.idle_timeout if busy else self.idle_timeout - idle
+        self._idle_call = self.clock.callLater(delay, self._check_idle)
+
+    def data_received(self, data):
+        """
+        Process a read from the connection.
+        """
+        logging.debug('Data Recieved')
+        self.bytes_received += len(data)
+        self.last_activity = self.clock.seconds()
+        self._process(self.framer.feed(data))
+
+    def buffer_updated(self, nbytes):
+        """
+        Process data read into the buffer from `framer.get_buffer()`.
+        """
+        logging.debug('Data Recieved')
+        self.bytes_received += nbytes
+        self.last_activity = self.clock.seconds()
+        self._process(self.framer.buffer_updated(nbytes))
+
+    def _process(self, messages):
+        try:
+            for message in messages:
+                self.dispatch(message)
+                if self.paused or self.aborted or self.backlog_full:
+                    # Leave the rest in the framer until we catch up.
+                    break
+        except (ParseError, VersionError) as e:
+            # Once framing is lost there is no way to resync the stream.
+            logging.error(str(e))
+            messages.close()
+            self.framer.clear()
+            self.link.close()
+            return
+        messages.close()
+
+    def pause_producing(self):
+        """
+        The write buffer is over the high watermark, so stop taking URBs
+        from the host and producing data for it.
+        """
+        if self.paused:
+            return
+        logging.debug('Pausing, the host is not keeping up')
+        self.paused = True
+        self.link.pause_reading()
+        if self.device:
+            self.device.pause_producing()
+
+    def resume_producing(self):
+        """
+        The write buffer has drained, so carry on with any URBs left over
+        from before pausing.
+        """
+        if not self.paused:
+            return
+        logging.debug('Resuming')
+        self.paused = False
+        if self.device:
+            self.device.resume_producing()
+        if not self.backlog_full:
+            self.link.resume_reading()
+            self._process(self.framer.buffered())
+        self._start_backlog()
+
+    def held(self):
+        """
+        Bytes of replies waiting to go to the host, both those queued for the
+        next flush and those in the write buffer.
+        """
+        return self._pending_bytes + self.link.buffered()
+
+    def _check_limit(self):
+        """
+        Apply the overflow policy if this connection is holding more than
+        `write_limit` bytes.
+        """
+        if self.write_limit is None or self.aborted:
+            return
+
+        buffered = self.held()
+        if self.device:
+            buffered += self.device.queued()
+        if buffered <= self.write_limit:
+            return
+
+        if self.overflow == 'drop' and self.device:
+            dropped = self.device.drop_queued()
+            logging.warning(f'Dropped {dropped} bytes queued for the host')
+            buffered = self.held()
+            if buffered <= self.write_limit:
+                return
+
+        logging.warning(f'Closing connection holding {buffered} bytes')
+        self.aborted = True
+        self._pending = []
+        self._pending_bytes = 0
+        self.link.abort()
+
+    def write(self, segments):
+        """
+        Queue a reply to be written at the end of this loop iteration.
+
+        Replies count towards the write buffer as soon as they are queued, so
+        a batch of URBs that would take it over `write_high` pauses part way
+        through, leaving the rest unread.
+        """
+        if self.aborted:
+            return
+        self._pending += segments
+        self._pending_bytes += sum(map(len, segments))
+        if self._flush_call is None:
+            self._flush_call = self.clock.callLater(0, self.flush)
+
+        if self.held() > self.write_high:
+            self.pause_producing()
+            self._check_limit()
+
+    def flush(self):
+        """
+        Hand every queued reply to the link in one go.
+        """
+        self._flush_call = None
+        if not self._pending:
+            return
+
+        if self.cork and self._uncork_call is None:
+            try:
+                self.link.set_cork(True)
+            except OSError as e:
+                # Still send the replies, just without corking them.
+                logging.warning(f'Unable to cork the connection: {e}')
+                self.cork = False
+            else:
+                # The transport may only send during the next I/O pass, so
+                # release the cork on the iteration after that.
+                self._uncork_call = self.clock.callLater(0, self._uncork)
+
+        pending, self._pending = self._pending, []
+        self._pending_bytes = 0
+        self._send(pending)
+        self._check_limit()
+
+        # A pause for replies that were still queued isn't one the transport
+        # knows about, so it won't resume it if the buffer never fills.
+        if self.paused and not self.aborted and \
+                self.link.buffered() <= self.write_high:
+            self.resume_producing()
+
+    def _send(self, segments):
+        self.bytes_sent += sum(map(len, segments))
+        self.link.send(segments)
+
+    def _uncork(self):
+        self._uncork_call = None
+        self.link.set_cork(False)
+
+    def dispatch(self, message):
+        match self.state:
+            case USBIPState.OP:
+                self.operation(message)
+            case USBIPState.USBIP:
+                self.command(message)
+
+    def operation(self, data):
+        message = USBIPClientMessage(data)
+        match message.cc:
+            case USBIPCommands.OP_REQ_DEVLIST:
+                logging.info('requesting devlist')
+                # sending the devlist, then kill the connection.
+                reply = USBIPReplyDevlist(self.devlist)
+                self._send(reply.segments())
+                self.link.close()
+
+            case USBIPCommands.OP_REQ_IMPORT:
+                logging.info(f'importing {message.busid}')
+                busid = str(message.busid)
+
+                # if the device exists and nobody else has it, we can
+                # transisition over to the usbip case and process those
+                # packets.
+                self.device = self.devlist.lookup(busid)
+                if self.device and not self.devlist.claim(busid, self):
+                    logging.warning(f'{busid} is already imported')
+                    self.device = None
+                # now send a message based on if this device lookup was
+                # succesful.
+                reply = USBIPReplyImport(
+                    busid, self.device, self.devlist.record(busid)
+                )
+                self._send([reply.pack()])
+
+                if self.device:
+                    self.busid = busid
+                    self.state = USBIPState.USBIP
+                    self.framer.length_function = urb_length
+                    self.device.subscribe(self.data_available)
+                else:
+                    self.link.close()
+
+            case _:
+                logging.error('unknown command?')
+
+    def command(self, data):
+        if not self.device:
+            return
+        res = process_message(data)
+        if res:
+            self.urbs += 1
+            match res.command:
+                case USBIPCmd.USBIP_CMD_SUBMIT:
+                    self.submit(res)
+                case USBIPCmd.USBIP_CMD_UNLINK:
+                    self.unlink(res)
+
+    def submit(self, res):
+        """
+        Start processing a URB, or queue it if too many are in flight or it
+        has to wait for the scheduler.
+        """
+        if self.scheduler is not None:
+            self._queue(res)
+            self.scheduler.ready(self)
+            return
+
+        if res.ep != 0:
+            self.transfer(res)
+            return
+
+        if len(self.inflight) >= self.queue_depth:
+            self._queue(res)
+            return
+
+        self._start(res)
+
+    def _queue(self, res):
+        self.backlog.append((self.clock.seconds(), res))
+        if len(self.backlog) >= self.backlog_limit and not self.backlog_full:
+            logging.debug('Backlog is full, pausing reading')
+            self.backlog_full = True
+            self.link.pause_reading()
+
+    def _backlog_drained(self):
+        """
+        Start reading again once a full backlog is down to half its limit.
+        """
+        if not self.backlog_full or \
+                len(self.backlog) > self.backlog_limit // 2:
+            return
+        self.backlog_full = False
+        if not self.paused:
+            self.link.resume_reading()
+            # Not straight away, as this is called while starting URBs.
+            self.clock.callLater(0, self._read_buffered)
+
+    def _read_buffered(self):
+        if not (self.paused or self.backlog_full):
+            self._process(self.framer.buffered())
+
+    def runnable(self):
+        """
+        Whether the next URB in the backlog can be started.
+        """
+        if not self.backlog or self.paused:
+            return False
+        _, res = self.backlog[0]
+        return res.ep != 0 or len(self.inflight) < self.queue_depth
+
+    def service(self, limit):
+        """
+        Start up to `limit` URBs from the backlog, returning how many were.
+        """
+        started = 0
+        while started < limit and self.runnable():
+            arrived, res = self.backlog.popleft()
+            delay = self.clock.seconds() - arrived
+            self.queue_delay_total += delay
+            self.queue_delay_max = max(self.queue_delay_max, delay)
+
+            if res.ep != 0:
+                self.transfer(res)
+            else:
+                self._start(res)
+            started += 1
+        self._backlog_drained()
+        return started
+
+    def _start(self, res):
+        usb_packet = USBPacket(0, res.ep, res.setup, res.transfer_buffer)
+        seqnum = res.seqnum
+
+        # now let the device process the message
+        try:
+            response = self.device.command(usb_packet)
+        except Exception:
+            logging.exception(f'device failed processing URB {seqnum}')
+            self.complete(seqnum, None)
+            return
+
+        if not isinstance(response, defer.Deferred) and \
+                not inspect.isawaitable(response):
+            self.complete(seqnum, response)
+            return
+
+        # Device will complete this later, so track it until it does.
+        d = self.link.as_deferred(response)
+        if self.urb_timeout:
+            d.addTimeout(self.urb_timeout, self.clock)
+        self.inflight[seqnum] = d
+        d.addCallbacks(
+            self._completed, self._failed,
+            callbackArgs=(seqnum, ), errbackArgs=(seqnum, )
+        )
+
+    def _completed(self, response, seqnum):
+        # Unlinked URBs have already been answered.
+        if self.inflight.pop(seqnum, None) is None:
+            return
+        self.complete(seqnum, response)
+        self._start_backlog()
+
+    def _failed(self, failure, seqnum):
+        if self.inflight.pop(seqnum, None) is None:
+            return
+
+        status = -errno.EPIPE
+        if failure.check(defer.TimeoutError):
+            logging.warning(f'URB {seqnum} timed out')
+            status = -errno.ETIMEDOUT
+        else:
+            logging.error(
+                f'device failed processing URB {seqnum}: {failure.value}'
+            )
+
+        self.write(self.encoder.ret_submit(seqnum, status))
+        self._start_backlog()
+
+    def _start_backlog(self):
+        if self.scheduler is None:
+            self.service(len(self.backlog))
+        elif self.runnable():
+            self.scheduler.ready(self)
+
+    def complete(self, seqnum, response):
+        """
+        Send the RET_SUBMIT for a URB the device has answered.
+        """
+        # decide how we pack this.
+        if response:
+            self.write(self.encoder.ret_submit(seqnum, 0, response.pack()))
+        else:
+            self.write(self.encoder.ret_submit(seqnum, -errno.EPIPE))
+
+    def transfer(self, res):
+        """
+        Handle a URB on one of the device's other endpoints.
+
+        OUT transfers are passed to the device and complete immediately. IN
+        transfers complete with data the device has pushed, and are parked
+        until there is some. URBs for endpoints the active configuration
+        doesn't have are stalled.
+        """
+        address = res.ep
+        if res.direction == USBIPDirection.USBIP_DIR_IN.value:
+            address |= 0x80
+        if not self.device.has_endpoint(address):
+            self.write(self.encoder.ret_submit(res.seqnum, -errno.EPIPE))
+            return
+
+        if res.direction == USBIPDirection.USBIP_DIR_OUT.value:
+            self.device.receive(res.ep, res.transfer_buffer)
+            self.write(self.encoder.ret_submit(
+                res.seqnum, 0, actual_length=len(res.transfer_buffer)
+            ))
+            return
+
+        parked = self.parked.setdefault(res.ep, deque())
+        parked.append(res)
+        self.data_available(res.ep)
+
+    def data_available(self, endpoint):
+        """
+        Complete parked URBs on an endpoint, in the order they arrived, for
+        as long as the device has data for them.
+        """
+        parked = self.parked.get(endpoint)
+        while parked:
+            data = self.device.pull(endpoint)
+            if data is None:
+                break
+            res = parked.popleft()
+            if len(data) > res.transfer_buffer_length:
+                data = data[:res.transfer_buffer_length]
+            # Twisted transports only take bytes.
+            self.write(self.encoder.ret_submit(res.seqnum, 0, bytes(data)))
+
+        self._check_limit()
+
+    def unlink(self, res):
+        """
+        Cancel a URB, if it hasn't been completed yet.
+        """
+        success = False
+
+        d = self.inflight.pop(res.unlink_seqnum, None)
+        if d is not None:
+            d.cancel()
+            success = True
+        else:
+            success = self._dequeue(res.unlink_seqnum)
+
+        self.write(self.encoder.ret_unlink(res.seqnum, success))
+        self._start_backlog()
+
+    def _dequeue(self, seqnum):
+        """
+        Remove a URB that is waiting in the backlog or parked.
+        """
+        for queued in self.backlog:
+            if queued[1].seqnum == seqnum:
+                self.backlog.remove(queued)
+                self._backlog_drained()
+                return True
+
+        for queue in self.parked.values():
+            for queued in queue:
+                if queued.seqnum == seqnum:
+                    queue.remove(queued)
+                    return True
+        return False
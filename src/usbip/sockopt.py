@@ -0,0 +1,30 @@
+"""
+Socket options shared by the engines.
+"""
+import socket
+
+
+# Once a connection has been silent for the keepalive time, the kernel sends
+# this many probes this many seconds apart before giving up on it.
+KEEPALIVE_INTERVAL = 10
+KEEPALIVE_COUNT = 3
+
+
+def set_keepalive(sock, idle):
+    """
+    Turn on TCP keepalive, so a host that vanished without closing the
+    connection (like a crashed VM) is noticed after `idle` seconds of silence
+    and the probes. None or 0 turns it off.
+    """
+    sock.setsockopt(socket.SOL_SOCKET, socket.SO_KEEPALIVE, int(bool(idle)))
+    if not idle:
+        return
+
+    # These are Linux's names, anywhere without them keeps its defaults.
+    for name, value in (('TCP_KEEPIDLE', idle),
+                        ('TCP_KEEPINTVL', KEEPALIVE_INTERVAL),
+                        ('TCP_KEEPCNT', KEEPALIVE_COUNT)):
+        if hasattr(socket, name):
+            sock.setsockopt(
+                socket.IPPROTO_TCP, getattr(socket, name), int(value)
+            )
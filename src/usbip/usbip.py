@@ -17,8 +17,9 @@ class USBSubmitStatus(Enum):
 
 
 class USBIPUnlinkStatus(Enum):
-    # 3426 is ECONNRESET, and this is the negation.
-    SUCCESS = -3426
+    # 104 is ECONNRESET, and this is the negation.
+    # 0 means the URB had already completed before the unlink.
+    SUCCESS = -104
     FAILURE = 0
 
 
@@ -60,110 +61,109 @@ class USBISOPacketDescriptor:
         pass
 
 
+_HEADER_BASIC = struct.Struct('>IIIII')
+_CMD_SUBMIT = struct.Struct('>IIIIIIIIII')
+_CMD_UNLINK = struct.Struct('>I')
+_COMMAND = struct.Struct('>I')
+
+
 class USBIPHeaderBasic:
-    def __init__(self, header):
+    """
+    `usbip_header_basic`, parsed straight out of the message.
+
+    `message` can be anything supporting the buffer protocol, and only a
+    memoryview over it is kept, so nothing gets copied.
+    """
+    __slots__ = ('_view', '_command', 'seqnum', 'devid', 'direction', 'ep')
+
+    def __init__(self, message):
+        self._view = memoryview(message)
         try:
-            header_ = header[:20]
-            command, seqnum, devid, direction, ep = struct.unpack(
-                ">IIIII",
-                header_
-            )
-            self.command = USBIPCmd(command)
-            self.seqnum = seqnum
-            self.devid = devid
-            self.direction = direction
-            self.ep = ep
+            self._command, self.seqnum, self.devid, self.direction, \
+                self.ep = _HEADER_BASIC.unpack_from(self._view)
         except struct.error:
             raise ParseError('Unable to unpack `usbip_header_basic`')
 
+    @property
+    def command(self):
+        return USBIPCmd(self._command)
+
 
 class USBIPCmdSubmit(USBIPHeaderBasic):
+    __slots__ = ('_transfer_flags', 'transfer_buffer_length', 'start_frame',
+                 'number_of_packets', 'interval')
+
     def __init__(self, message):
-        super().__init__(message)
+        # Unpacks the basic header as well, so it's a single call per URB.
+        self._view = memoryview(message)
         try:
-            body = message[20:]
-            before_seg = body[:20]
-            transfer_flags, transfer_buffer_length, start_frame, \
-                number_of_packets, interval = \
-                struct.unpack('>IIIII', before_seg)
-
-            setup_message = message[0x28:0x28+8]
-
-            n = 0
-            if self.direction == USBIPDirection.USBIP_DIR_OUT.value:
-                n = transfer_buffer_length
-
-            transfer_buffer = b''
-            if n > 0:
-                transfer_buffer = message[0x30:0x30+n]
-
-            m = 0
-            if number_of_packets != 0xffffffff or start_frame == 0:
-                m = number_of_packets
-
-            # attempt to read iso packets
-            # TODO, this needs parsing!
-            iso_packets = b''
-            if m > 0:
-                # call USBISOPacketDescriptor() on each one.
-                iso_packets = body[0x30+n:0x30+n+m]
-
-            # Write it out
-            self.transfer_flags = USBURBTransferFlags(transfer_flags)
-            self.transfer_buffer_length = transfer_buffer_length
-            self.start_frame = start_frame
-            self.number_of_packets = number_of_packets
-            self.interval = interval
-            self.setup = setup_message
-            self.transfer_buffer = transfer_buffer
-            self.iso_packets = iso_packets
-
+            self._command, self.seqnum, self.devid, self.direction, \
+                self.ep, self._transfer_flags, self.transfer_buffer_length, \
+                self.start_frame, self.number_of_packets, self.interval = \
+                _CMD_SUBMIT.unpack_from(self._view)
         except struct.error:
             raise ParseError('Unable to unpack USBIP_CMD_SUBMIT')
 
+        if len(self._view) < 0x30 + self._transfer_length():
+            raise ParseError('USBIP_CMD_SUBMIT is truncated')
+
+    def _transfer_length(self):
+        if self.direction == USBIPDirection.USBIP_DIR_OUT.value:
+            return self.transfer_buffer_length
+        return 0
+
+    @property
+    def transfer_flags(self):
+        return USBURBTransferFlags(self._transfer_flags)
+
+    @property
+    def setup(self):
+        return self._view[0x28:0x30]
+
+    @property
+    def transfer_buffer(self):
+        return self._view[0x30:0x30 + self._transfer_length()]
+
+    @property
+    def iso_packets(self):
+        # TODO, this needs parsing!
+        # call USBISOPacketDescriptor() on each one.
+        m = 0
+        if self.number_of_packets != 0xffffffff:
+            m = self.number_of_packets
+
+        start = 0x30 + self._transfer_length()
+        return self._view[start:start + 16 * m]
+
 
 class USBIPRetSubmit:
-    def __init__(self, seqnum, status, data):
+    def __init__(self, seqnum, status, data, actual_length=None):
         self.data = data
         self.seqnum = seqnum
         self.status = status
+        self.actual_length = actual_length
+
+    def segments(self, encoder=None):
+        """
+        The reply as a header and the transfer buffer, to be written
+        separately so the payload is never copied into the header.
+        """
+        encoder = encoder or USBIPReplyEncoder()
+        return encoder.ret_submit(
+            self.seqnum, self.status, self.data, self.actual_length
+        )
 
     def pack(self):
-        message = b''
-        # header
-        message += struct.pack('>I', USBIPCmd.USBIP_RET_SUBMIT.value)
-        message += struct.pack('>I', self.seqnum)
-        message += struct.pack('>I', 0)
-        message += struct.pack('>I', 0)
-        message += struct.pack('>I', 0)
-        # body
-        # status
-        message += struct.pack('>i', self.status)
-        # actual length
-        message += struct.pack('>I', len(self.data))
-        # start_frame
-        message += struct.pack('>I', 0)
-        # number_of_packets
-        message += struct.pack('>I', 0)
-        # 0xffffffff
-        # error count
-        message += struct.pack('>I', 0)
-        # setup padding
-        message += b'\x00'*8
-        # transfer buffer
-        message += self.data
-        # iso_packet_descriptor
-
-        return message
+        return b''.join(self.segments())
 
 
 class USBIPCmdUnlink(USBIPHeaderBasic):
+    __slots__ = ('unlink_seqnum', )
+
     def __init__(self, message):
         super().__init__(message)
         try:
-            body = message[20:]
-            unlink_seqnum = struct.unpack('>1I24x', body)
-            self.unlink_seqnum = unlink_seqnum
+            self.unlink_seqnum, = _CMD_UNLINK.unpack_from(self._view, 0x14)
         except struct.error:
             raise ParseError('Unable to unpack USBIP_CMD_UNLINK')
 
@@ -173,34 +173,185 @@ class USBIPRetUnlink:
         self.success = success
         self.seqnum = seqnum
 
+    def segments(self, encoder=None):
+        encoder = encoder or USBIPReplyEncoder()
+        return encoder.ret_unlink(self.seqnum, self.success)
+
     def pack(self):
-        message = b''
-        # header
-        message += struct.pack('>I', USBIPCmd.USBIP_RET_UNLINK.value)
-        message += struct.pack('>I', self.seqnum)
-        message += struct.pack('>I', 0)
-        message += struct.pack('>I', 0)
-        message += struct.pack('>I', 0)
+        return b''.join(self.segments())
+
+
+# Both replies share the 48 byte header layout:
+# command, seqnum, devid, direction, ep, then the command specific part.
+_RET_SUBMIT = struct.Struct('>IIIIIiIIII8x')
+_RET_UNLINK = struct.Struct('>IIIIIi24x')
+
+
+class USBIPReplyEncoder:
+    """
+    Encodes RET_SUBMIT / RET_UNLINK replies.
+
+    The header is packed in a single call into a buffer that is reused for
+    every reply, and is returned alongside the payload as separate segments
+    for `writeSequence`, so the cost of a reply doesn't grow with the size of
+    the transfer buffer.
+
+    Transports hold onto what they are given until it has been sent, so each
+    reply gets a snapshot of the header rather than the buffer itself.
+    """
+
+    def __init__(self):
+        self._header = bytearray(_RET_SUBMIT.size)
+
+    def ret_submit(self, seqnum, status, data=b'', actual_length=None):
+        if actual_length is None:
+            actual_length = len(data)
+
+        _RET_SUBMIT.pack_into(
+            self._header, 0,
+            USBIPCmd.USBIP_RET_SUBMIT.value, seqnum, 0, 0, 0,
+            # status, actual_length, start_frame, number_of_packets,
+            # error_count
+            status, actual_length, 0, 0, 0
+        )
+
+        if not data:
+            return [bytes(self._header)]
+
+        return [bytes(self._header), data]
 
-        # body
-        if self.success:
-            message += struct.pack('>I', USBIPUnlinkStatus.SUCCESS.value)
-        else:
-            message += struct.pack('>I', USBIPUnlinkStatus.FAILURE.value)
+    def ret_unlink(self, seqnum, success):
+        status = USBIPUnlinkStatus.SUCCESS if success \
+            else USBIPUnlinkStatus.FAILURE
 
-        # padding
-        message += b'\x00'*24
+        _RET_UNLINK.pack_into(
+            self._header, 0,
+            USBIPCmd.USBIP_RET_UNLINK.value, seqnum, 0, 0, 0,
+            status.value
+        )
 
-        return message
+        return [bytes(self._header)]
+
+
+USBIP_HEADER_LENGTH = 0x30
+ISO_PACKET_DESCRIPTOR_LENGTH = 16
+
+
+def pack_cmd_submit(seqnum, devid, direction, ep, transfer_buffer_length,
+                    setup=bytes(8), data=b'', transfer_flags=0,
+                    start_frame=0, number_of_packets=0, interval=0):
+    """
+    A USBIP_CMD_SUBMIT, as sent by the client. `data` is the transfer buffer
+    for OUT transfers.
+    """
+    return _CMD_SUBMIT.pack(
+        USBIPCmd.USBIP_CMD_SUBMIT.value, seqnum, devid, direction.value, ep,
+        transfer_flags, transfer_buffer_length, start_frame,
+        number_of_packets, interval
+    ) + bytes(setup) + bytes(data)
+
+
+def pack_cmd_unlink(seqnum, devid, unlink_seqnum):
+    """
+    A USBIP_CMD_UNLINK, as sent by the client.
+    """
+    return _HEADER_BASIC.pack(
+        USBIPCmd.USBIP_CMD_UNLINK.value, seqnum, devid, 0, 0
+    ) + _CMD_UNLINK.pack(unlink_seqnum) + bytes(24)
+
+
+class USBIPReply(USBIPHeaderBasic):
+    """
+    A USBIP_RET_SUBMIT or USBIP_RET_UNLINK, as read by a client.
+
+    RET_UNLINK only has `status`, the other fields are left as zero.
+    """
+    __slots__ = ('status', 'actual_length', 'start_frame',
+                 'number_of_packets', 'error_count')
+
+    def __init__(self, message):
+        self._view = memoryview(message)
+        try:
+            self._command, self.seqnum, self.devid, self.direction, \
+                self.ep, self.status, self.actual_length, \
+                self.start_frame, self.number_of_packets, \
+                self.error_count = _RET_SUBMIT.unpack_from(self._view)
+        except struct.error:
+            raise ParseError('Unable to unpack USBIP_RET_*')
+
+    @property
+    def data(self):
+        return self._view[USBIP_HEADER_LENGTH:]
+
+
+def ret_length(buffer, offset, direction_of):
+    """
+    Length of the USBIP_RET_* message starting at offset, or None if the
+    header hasn't fully arrived yet.
+
+    RET_SUBMIT doesn't say which way the transfer went, so `direction_of` is
+    called with the seqnum to get the direction of the URB it completes. Only
+    IN transfers carry data back.
+    """
+    if len(buffer) - offset < USBIP_HEADER_LENGTH:
+        return None
+
+    command, seqnum = struct.unpack_from('>II', buffer, offset)
+    match command:
+        case USBIPCmd.USBIP_RET_SUBMIT.value:
+            actual_length, _, number_of_packets = \
+                struct.unpack_from('>III', buffer, offset + 0x18)
+            length = USBIP_HEADER_LENGTH
+            if direction_of(seqnum) == USBIPDirection.USBIP_DIR_IN:
+                length += actual_length
+            if number_of_packets not in (0, 0xffffffff):
+                length += number_of_packets * ISO_PACKET_DESCRIPTOR_LENGTH
+            return length
+        case USBIPCmd.USBIP_RET_UNLINK.value:
+            return USBIP_HEADER_LENGTH
+        case _:
+            raise ParseError(f'Unknown reply {command:#x}, lost framing')
+
+
+def urb_length(buffer, offset=0):
+    """
+    Length of the USBIP_CMD_* message starting at offset, or None if the
+    header hasn't fully arrived yet.
+
+    CMD_SUBMIT carries the transfer buffer for OUT transfers, followed by the
+    ISO packet descriptors.
+    """
+    if len(buffer) - offset < USBIP_HEADER_LENGTH:
+        return None
+
+    command, _, _, direction = struct.unpack_from('>IIII', buffer, offset)
+    match command:
+        case USBIPCmd.USBIP_CMD_SUBMIT.value:
+            transfer_buffer_length, _, number_of_packets = \
+                struct.unpack_from('>III', buffer, offset + 0x18)
+            length = USBIP_HEADER_LENGTH
+            if direction == USBIPDirection.USBIP_DIR_OUT.value:
+                length += transfer_buffer_length
+            if number_of_packets not in (0, 0xffffffff):
+                length += number_of_packets * ISO_PACKET_DESCRIPTOR_LENGTH
+            return length
+        case USBIPCmd.USBIP_CMD_UNLINK.value:
+            return USBIP_HEADER_LENGTH
+        case _:
+            raise ParseError(f'Unknown command {command:#x}, lost framing')
 
 
 def process_message(message):
-    header = USBIPHeaderBasic(message[:0x14])
+    try:
+        command, = _COMMAND.unpack_from(message)
+    except struct.error:
+        raise ParseError('Unable to unpack `usbip_header_basic`')
+
     res = None
-    match header.command:
-        case USBIPCmd.USBIP_CMD_SUBMIT:
+    match command:
+        case USBIPCmd.USBIP_CMD_SUBMIT.value:
             res = USBIPCmdSubmit(message)
-        case USBIPCmd.USBIP_CMD_UNLINK:
+        case USBIPCmd.USBIP_CMD_UNLINK.value:
             res = USBIPCmdUnlink(message)
         case _:
             pass
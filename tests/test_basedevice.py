@@ -0,0 +1,75 @@
+"""
+Control request dispatch in BaseDevice.
+"""
+import asyncio
+import struct
+
+from twisted.internet import defer
+
+from device.basedevice import control_request
+from device.descriptors import FixedDescriptor
+from device.devicelist import DeviceList
+from devices import testdevice
+from protocol.usb import USBPacket
+from usbip.loopback import LoopbackClient
+
+
+VENDOR_IN = 0xc0
+
+
+def vendor_setup(bRequest, wLength):
+    return struct.pack('<BBHHH', VENDOR_IN, bRequest, 0, 0, wLength)
+
+
+class DeferredDevice(testdevice.TestDevice):
+    """
+    Answers vendor requests later, through Deferreds it hands out.
+    """
+
+    def __init__(self):
+        super().__init__()
+        self.waiting = []
+
+    @control_request(VENDOR_IN, 0x01)
+    def vendor_deferred(self, setup):
+        d = defer.Deferred()
+        self.waiting.append(d)
+        return d
+
+    @control_request(VENDOR_IN, 0x02)
+    async def vendor_coroutine(self, setup):
+        return [FixedDescriptor(b'coroutine')]
+
+
+def test_deferred_handler_is_cut_to_wlength():
+    device = DeferredDevice()
+    d = device.command(USBPacket(0, 0, vendor_setup(0x01, 4), b''))
+    assert isinstance(d, defer.Deferred)
+
+    results = []
+    d.addCallback(results.append)
+    device.waiting.pop().callback([FixedDescriptor(b'deferred')])
+    assert results[0].pack() == b'defe'
+
+
+def test_awaitable_handler_is_cut_to_wlength():
+    device = DeferredDevice()
+    coroutine = device.command(USBPacket(0, 0, vendor_setup(0x02, 5), b''))
+    assert asyncio.run(coroutine).pack() == b'corou'
+
+
+def test_deferred_handler_completes_the_urb():
+    device = DeferredDevice()
+    devlist = DeviceList()
+    devlist.add(device)
+
+    client = LoopbackClient(devlist)
+    client.import_device('1-1')
+    seqnum = client.submit(setup=vendor_setup(0x01, 4), length=4)
+    assert seqnum not in client.replies
+
+    device.waiting.pop().callback([FixedDescriptor(b'deferred')])
+    client.run()
+    reply = client.replies[seqnum]
+    assert reply.status == 0
+    assert bytes(reply.data[:reply.actual_length]) == b'defe'
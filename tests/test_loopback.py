@@ -0,0 +1,288 @@
+"""
+The USBIP protocol, driven through LoopbackClient on both engines.
+"""
+import pytest
+
+from device.descriptors import FixedDescriptor
+from device.devicelist import DeviceList
+from device.endpoint import Endpoint
+from device.interface import Interface
+from usbip.loopback import AsyncioLoopbackClient, LoopbackClient
+from usbip.usbip import USBIPUnlinkStatus
+
+from test_basedevice import DeferredDevice, vendor_setup
+
+
+GET_DEVICE_DESCRIPTOR = bytes.fromhex('8006000100001200')
+
+
+class StreamDevice(DeferredDevice):
+    """
+    Adds an IN endpoint for data pushed by the test.
+    """
+
+    def __init__(self):
+        super().__init__()
+        interface = Interface(1)
+        interface.add_endpoints([Endpoint(0x81, 64, 1)])
+        self._configurations[0].add_interface(interface)
+
+
+@pytest.fixture
+def device():
+    return StreamDevice()
+
+
+@pytest.fixture
+def devlist(device):
+    devlist = DeviceList()
+    devlist.add(device)
+    return devlist
+
+
+@pytest.fixture(params=[LoopbackClient, AsyncioLoopbackClient],
+                ids=['twisted', 'asyncio'])
+def connect(request, devlist):
+    """
+    Opens connections to the device list, with the engine under test.
+    """
+    clients = []
+
+    def connect(**options):
+        client = request.param(devlist, **options)
+        clients.append(client)
+        return client
+
+    yield connect
+    for client in clients:
+        if client.connected:
+            client.close()
+
+
+@pytest.fixture
+def client(connect):
+    client = connect()
+    assert client.import_device('1-1') is not None
+    return client
+
+
+def descriptor_urbs(count):
+    return [
+        {'setup': GET_DEVICE_DESCRIPTOR, 'length': 0x12}
+        for _ in range(count)
+    ]
+
+
+def assert_descriptor(reply):
+    assert reply.status == 0
+    assert reply.actual_length == 0x12
+    assert bytes(reply.data[:4]) == bytes.fromhex('12010002')
+
+
+def test_devlist(connect):
+    client = connect()
+    record, = client.list_devices()
+    assert record.busid == '1-1'
+    assert record.idVendor == 0x1337
+    assert not client.connected
+
+
+def test_import(connect, device):
+    client = connect()
+    record = client.import_device('1-1')
+    assert record.busid == '1-1'
+    assert record.idProduct == 0x1234
+    assert_descriptor(client.control(GET_DEVICE_DESCRIPTOR))
+
+
+def test_import_unknown_busid(connect):
+    client = connect()
+    assert client.import_device('9-9') is None
+    assert not client.connected
+
+
+def test_import_is_exclusive(connect, client):
+    assert connect().import_device('1-1') is None
+
+    client.close()
+    assert connect().import_device('1-1') is not None
+
+
+def test_pipelined_urbs(client):
+    seqnums = client.submit_all(descriptor_urbs(16))
+    for seqnum in seqnums:
+        assert_descriptor(client.replies[seqnum])
+
+
+def test_split_reads(client):
+    (first, second), messages = zip(
+        *(client.cmd_submit(**urb) for urb in descriptor_urbs(2))
+    )
+    stream = b''.join(messages)
+
+    # Cut inside the first header, then inside the second.
+    client.send(stream[:7])
+    assert not client.replies
+    client.send(stream[7:60])
+    assert_descriptor(client.replies[first])
+    assert second not in client.replies
+    client.send(stream[60:])
+    assert_descriptor(client.replies[second])
+
+
+def test_small_reads():
+    devlist = DeviceList()
+    devlist.add(StreamDevice())
+    client = AsyncioLoopbackClient(devlist, read_size=5)
+    client.import_device('1-1')
+    seqnums = client.submit_all(descriptor_urbs(4))
+    for seqnum in seqnums:
+        assert_descriptor(client.replies[seqnum])
+    client.close()
+
+
+def test_unlink_queued(connect, device):
+    client = connect(queue_depth=1)
+    client.import_device('1-1')
+    setup = vendor_setup(0x01, 4)
+    first, second = client.submit_all(
+        [{'setup': setup, 'length': 4}, {'setup': setup, 'length': 4}]
+    )
+    assert len(device.waiting) == 1
+
+    unlink = client.unlink(second)
+    assert client.replies[unlink].status == USBIPUnlinkStatus.SUCCESS.value
+
+    device.waiting.pop().callback([FixedDescriptor(b'first')])
+    client.run()
+    assert bytes(client.replies[first].data) == b'firs'
+    # The unlinked URB was never started.
+    assert not device.waiting
+    assert second not in client.replies
+
+
+def test_unlink_inflight(client, device):
+    seqnum = client.submit(setup=vendor_setup(0x01, 4), length=4)
+
+    unlink = client.unlink(seqnum)
+    assert client.replies[unlink].status == USBIPUnlinkStatus.SUCCESS.value
+
+    device.waiting.pop().callback([FixedDescriptor(b'late')])
+    client.run()
+    assert seqnum not in client.replies
+
+
+def test_unlink_parked(client, device):
+    seqnum = client.submit(ep=1, length=64)
+    assert seqnum not in client.replies
+
+    unlink = client.unlink(seqnum)
+    assert client.replies[unlink].status == USBIPUnlinkStatus.SUCCESS.value
+
+    device.push(1, b'data')
+    client.run()
+    assert seqnum not in client.replies
+    assert device.queued() == 4
+
+
+def test_unlink_completed(client):
+    seqnum = client.submit(setup=GET_DEVICE_DESCRIPTOR, length=0x12)
+    assert seqnum in client.replies
+
+    unlink = client.unlink(seqnum)
+    assert client.replies[unlink].status == USBIPUnlinkStatus.FAILURE.value
+
+
+def test_parked_urb_completes_with_pushed_data(client, device):
+    seqnum = client.submit(ep=1, length=3)
+    device.push(1, b'data')
+    client.run()
+    assert bytes(client.replies[seqnum].data) == b'dat'
+
+
+def test_write_limit_pauses(connect):
+    client = connect(write_high=256, write_low=64)
+    client.import_device('1-1')
+    session = client.protocol.session
+
+    client.reading = False
+    seqnums = client.submit_all(descriptor_urbs(32))
+    assert session.paused
+    assert client.transport.reading_paused
+    assert session.held() < 512
+    # The rest are still waiting to be read.
+    assert session.urbs < 32
+
+    client.reading = True
+    client.run()
+    assert not session.paused
+    for seqnum in seqnums:
+        assert_descriptor(client.replies[seqnum])
+
+
+def test_write_limit_aborts(connect, device):
+    client = connect(write_high=256, write_limit=1024)
+    client.import_device('1-1')
+
+    client.reading = False
+    seqnums = [client.submit(ep=1, length=64) for _ in range(32)]
+    for _ in seqnums:
+        device.push(1, bytes(64))
+    client.run()
+
+    assert not client.connected
+    assert device.queued() == 0
+
+
+def test_write_limit_drops_queued_data(connect, device):
+    client = connect(write_high=256, write_limit=1024, overflow='drop')
+    client.import_device('1-1')
+
+    device.push(1, bytes(2048))
+    client.run()
+
+    assert client.connected
+    assert device.queued() == 0
+
+
+def test_backlog_limit_pauses_reading(connect, device):
+    client = connect(queue_depth=1, backlog_limit=4)
+    client.import_device('1-1')
+    setup = vendor_setup(0x01, 4)
+    seqnums = client.submit_all([{'setup': setup, 'length': 4}] * 8)
+    session = client.protocol.session
+    assert session.backlog_full
+    assert len(session.backlog) == 4
+
+    for seqnum in seqnums:
+        device.waiting.pop().callback([FixedDescriptor(b'done')])
+        client.run()
+        assert client.replies[seqnum].status == 0
+    assert not session.backlog_full
+
+
+def test_deferred_control_handler(client, device):
+    seqnum = client.submit(setup=vendor_setup(0x01, 4), length=4)
+    assert seqnum not in client.replies
+
+    device.waiting.pop().callback([FixedDescriptor(b'deferred')])
+    client.run()
+    reply = client.replies[seqnum]
+    assert reply.status == 0
+    assert bytes(reply.data) == b'defe'
+
+
+def test_awaitable_control_handler(client):
+    seqnum = client.submit(setup=vendor_setup(0x02, 5), length=5)
+    reply = client.replies[seqnum]
+    assert reply.status == 0
+    assert bytes(reply.data) == b'corou'
+
+
+def test_urb_timeout(connect, device):
+    client = connect(urb_timeout=5)
+    client.import_device('1-1')
+    seqnum = client.submit(setup=vendor_setup(0x01, 4), length=4)
+
+    client.run(5)
+    assert client.replies[seqnum].status != 0